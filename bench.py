@@ -0,0 +1,907 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from collections import Counter
+from datetime import date, datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOKEN = '123456:bench'
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Port {port} did not open')
+
+
+# --- Fake Telegram Bot API ---
+# Локальна заміна api.telegram.org: віддає оновлення через getUpdates (long-poll)
+# і запам'ятовує все, що бот надсилає у відповідь
+class FakeBotApi:
+    def __init__(self):
+        self.updates = []
+        self.update_id = 0
+        self.message_id = 0
+        self.cond = threading.Condition()
+        self.calls = {}
+        self.listeners = []
+        self.server = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}'
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                parsed = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode('utf-8')
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update({k: v[0] for k, v in parse_qs(body).items()})
+                method = parsed.path.rsplit('/', 1)[-1]
+                result = api.handle(method, params)
+                payload = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # бот зупинився (SIGTERM) посеред long-poll
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def stamp(self, update):
+        with self.cond:
+            self.update_id += 1
+            update['update_id'] = self.update_id
+        return update
+
+    def push(self, update):
+        with self.cond:
+            self.stamp(update)
+            self.updates.append(update)
+            self.cond.notify_all()
+        return update
+
+    def handle(self, method, params):
+        with self.cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            deadline = time.monotonic() + float(params.get('timeout') or 0)
+            with self.cond:
+                self.updates = [u for u in self.updates if u['update_id'] >= offset]
+                while not self.updates and time.monotonic() < deadline:
+                    self.cond.wait(deadline - time.monotonic())
+                return list(self.updates[:int(params.get('limit') or 100)])
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method in ('sendMessage', 'editMessageText'):
+            with self.cond:
+                self.message_id += 1
+                message_id = int(params.get('message_id') or self.message_id)
+            chat_id = int(params['chat_id'])
+            for listener in self.listeners:
+                listener(method, chat_id, dict(params, message_id=message_id))
+            return {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                    'chat': {'id': chat_id, 'type': 'private'}}
+        chat_id = None
+        if method == 'answerCallbackQuery':
+            # id колбеку має вигляд "<uid>:<n>", див. callback_update
+            chat_id = int(str(params.get('callback_query_id', '0')).split(':')[0])
+        for listener in self.listeners:
+            listener(method, chat_id, params)
+        return True
+
+
+def message_update(chat_id, text):
+    return {'message': {
+        'message_id': 1, 'date': int(time.time()), 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'U{chat_id}'},
+    }}
+
+
+def callback_update(chat_id, data, message_id, n):
+    return {'callback_query': {
+        'id': f'{chat_id}:{n}', 'chat_instance': str(chat_id), 'data': data,
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'U{chat_id}'},
+        'message': {'message_id': message_id, 'date': int(time.time()), 'text': '-',
+                    'chat': {'id': chat_id, 'type': 'private'}},
+    }}
+
+
+def buttons(params):
+    markup = params.get('reply_markup')
+    if not markup:
+        return []
+    markup = json.loads(markup) if isinstance(markup, str) else markup
+    return [b['callback_data'] for row in markup.get('inline_keyboard', []) for b in row if 'callback_data' in b]
+
+
+def proc_tree(pid):
+    pids = [pid]
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/task/{p}/children') as f:
+                pids += [int(c) for c in f.read().split()]
+        except OSError:
+            pass
+    return pids
+
+
+def proc_stats(pid):
+    # Сума по процесу і його нащадках (воркери cluster.py)
+    stats = Counter()
+    for p in proc_tree(pid):
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith(('VmRSS:', 'VmHWM:')):
+                        stats[line.split(':')[0]] += int(line.split()[1]) * 1024
+            with open(f'/proc/{p}/io') as f:
+                for line in f:
+                    key, value = line.split(':')
+                    stats[key] += int(value)
+        except OSError:
+            pass
+    return stats
+
+
+def start_bot(api, workdir, script='index.py', **env):
+    # Ліміти відправки за замовчуванням зняті; SEND_CHAT_RATE=1 у середовищі - як у Telegram
+    env = {'SEND_GLOBAL_RATE': '100000', 'SEND_CHAT_RATE': '100000', **os.environ,
+           **env, 'TELEGRAM_TOKEN': TOKEN, 'TELEGRAM_API_URL': api.url}
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script)], cwd=workdir, env=env)
+
+
+# --- Scenarios ---
+def bench_ingest(mode, users, per_user):
+    # Замкнений цикл: кожен користувач надсилає оновлення і чекає відповіді бота перед наступним
+    api = FakeBotApi().start()
+    replies = {uid: threading.Event() for uid in range(1, users + 1)}
+    api.listeners.append(lambda method, chat, params: chat in replies and replies[chat].set())
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    bot = start_bot(api, workdir, RUN_MODE=mode, WEBHOOK_HOST='127.0.0.1', WEBHOOK_PORT=str(port))
+    try:
+        if mode == 'webhook':
+            wait_port(port)
+
+            def deliver(update):
+                req = urllib.request.Request(f'http://127.0.0.1:{port}/webhook', json.dumps(api.stamp(update)).encode(),
+                                             {'Content-Type': 'application/json'})
+                urllib.request.urlopen(req).read()
+        else:
+            deliver = api.push
+        # прогрів: перше оновлення проходить увесь старт бота
+        replies[1].clear()
+        deliver(message_update(1, '/start'))
+        if not replies[1].wait(30):
+            raise RuntimeError('Bot did not answer')
+
+        latencies = []
+        lock = threading.Lock()
+
+        def user_loop(uid):
+            for _ in range(per_user):
+                replies[uid].clear()
+                t = time.perf_counter()
+                deliver(message_update(uid, 'Перегляд поточного місяця'))
+                if not replies[uid].wait(10):
+                    raise RuntimeError(f'No reply for {uid}')
+                with lock:
+                    latencies.append(time.perf_counter() - t)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=user_loop, args=(uid,)) for uid in replies]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        bot.terminate()
+        bot.wait(10)
+        api.stop()
+    return {'mode': mode, 'updates': len(latencies), 'updates_per_sec': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000}
+
+
+# --- Load test ---
+# Синтетичні користувачі проходять реальні сценарії через фейковий Bot API:
+# реєстрація, відпустка, генерація розкладу і повний ланцюжок обміну ex_month_ → ex_yes_
+class LoadClient:
+    def __init__(self, api, deliver):
+        self.api = api
+        self.deliver = deliver
+        self.cond = threading.Condition()
+        self.inbox = {}
+        self.offers = {}
+        self.latencies = {}
+        self.n = 0
+        api.listeners.append(self._on_call)
+
+    def _on_call(self, method, chat_id, params):
+        if chat_id is None:
+            return
+        with self.cond:
+            if any(b.startswith('ex_yes_') for b in buttons(params)):
+                # пропозиція обміну від колеги, а не відповідь на власний крок
+                self.offers.setdefault(chat_id, []).append(buttons(params))
+            else:
+                self.inbox.setdefault(chat_id, []).append((method, params))
+            self.cond.notify_all()
+
+    def _call(self, action, uid, update, accept, timeout=15):
+        with self.cond:
+            mark = len(self.inbox.get(uid, []))
+        t = time.perf_counter()
+        self.deliver(update)
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                for method, params in self.inbox.get(uid, [])[mark:]:
+                    if accept(method, params):
+                        self.latencies.setdefault(action, []).append(time.perf_counter() - t)
+                        return params
+                mark = len(self.inbox.get(uid, []))
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise RuntimeError(f'No reply to {action} for {uid}')
+                self.cond.wait(left)
+
+    def say(self, action, uid, text):
+        return self._call(action, uid, message_update(uid, text), lambda m, p: m == 'sendMessage')
+
+    def tap(self, action, uid, data, message_id, accept=None):
+        with self.cond:
+            self.n += 1
+            n = self.n
+        accept = accept or (lambda m, p: m in ('sendMessage', 'editMessageText'))
+        return self._call(action, uid, callback_update(uid, data, message_id, n), accept)
+
+
+def run_parallel(uids, fn):
+    errors = []
+
+    def wrapped(uid):
+        try:
+            fn(uid)
+        except Exception as e:
+            errors.append(e)
+
+    pool = [threading.Thread(target=wrapped, args=(uid,)) for uid in uids]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+def bench_load(users, mode='polling', backend='json', workers=2):
+    api = FakeBotApi().start()
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix='load-')
+    if mode == 'cluster':
+        backend = 'sqlite'  # воркери ділять стан лише через базу
+        bot = start_bot(api, workdir, script='cluster.py', STORAGE_BACKEND=backend, CLUSTER_WORKERS=str(workers))
+    else:
+        bot = start_bot(api, workdir, RUN_MODE=mode, STORAGE_BACKEND=backend, FLUSH_INTERVAL='0.2',
+                        WEBHOOK_HOST='127.0.0.1', WEBHOOK_PORT=str(port))
+    if mode == 'webhook':
+        wait_port(port)
+
+        def deliver(update):
+            req = urllib.request.Request(f'http://127.0.0.1:{port}/webhook', json.dumps(api.stamp(update)).encode(),
+                                         {'Content-Type': 'application/json'})
+            urllib.request.urlopen(req).read()
+    else:
+        deliver = api.push
+    client = LoadClient(api, deliver)
+    uids = list(range(1000, 1000 + users))
+    today = date.today()
+    phases = []
+
+    def phase(name, actions, fn):
+        before = proc_stats(bot.pid)
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        time.sleep(0.5)  # дочекатися відкладеного запису на диск
+        after = proc_stats(bot.pid)
+        written = after.get('write_bytes', 0) - before.get('write_bytes', 0)
+        phases.append((name, actions, elapsed, written))
+
+    def register(uid):
+        client.say('register', uid, 'Зареєструватися')
+        client.say('register_name', uid, f'User {uid}')
+        client.say('register_emoji', uid, '🙂')
+
+    def vacation(uid):
+        rnd = random.Random(uid)
+        start = today.replace(day=rnd.randint(1, 20))
+        client.say('vacation', uid, 'Відпустка')
+        client.say('vacation_from', uid, start.isoformat())
+        client.say('vacation_to', uid, (start + timedelta(days=rnd.randint(0, 5))).isoformat())
+
+    requested = []
+
+    def exchange(uid):
+        rnd = random.Random(uid)
+        msg = client.say('exchange', uid, 'Помінятись')
+        reply = client.tap('ex_month_', uid, 'ex_month_current', msg['message_id'])
+        mine = [b for b in buttons(reply) if b.startswith('ex_mydate_')]
+        if not mine:
+            return
+        reply = client.tap('ex_mydate_', uid, mine[0], msg['message_id'])
+        colleagues = [b for b in buttons(reply) if b.startswith('ex_user_')]
+        if not colleagues:
+            return
+        reply = client.tap('ex_user_', uid, rnd.choice(colleagues), msg['message_id'])
+        theirs = [b for b in buttons(reply) if b.startswith('ex_targetdate_')]
+        if not theirs:
+            return
+        client.tap('ex_targetdate_', uid, rnd.choice(theirs), msg['message_id'],
+                   accept=lambda m, p: m == 'sendMessage')
+        requested.append(uid)
+
+    def confirm(uid):
+        with client.cond:
+            offers = list(client.offers.get(uid, []))
+        for offer in offers:
+            yes = next(b for b in offer if b.startswith('ex_yes_'))
+            client.tap('ex_yes_', uid, yes, 1, accept=lambda m, p: m == 'answerCallbackQuery')
+
+    try:
+        client.say('start', uids[0], '/start')
+        phase('register', users * 3, lambda: run_parallel(uids, register))
+        phase('vacation', users * 3, lambda: run_parallel(uids, vacation))
+        phase('generate', 2, lambda: (client.say('generate', uids[0], 'Генерація поточного місяця'),
+                                      client.say('generate', uids[0], 'Генерація наступного місяця')))
+        phase('view', users, lambda: run_parallel(uids, lambda uid: client.say('view', uid, 'Перегляд поточного місяця')))
+        phase('exchange', users * 5, lambda: run_parallel(uids, exchange))
+        phase('confirm', len(requested), lambda: run_parallel(uids, confirm))
+        memory = proc_stats(bot.pid)
+    finally:
+        bot.terminate()
+        bot.wait(10)
+        api.stop()
+
+    total_actions = sum(p[1] for p in phases)
+    total_time = sum(p[2] for p in phases)
+    return {'users': users, 'mode': mode, 'backend': backend, 'phases': phases,
+            'latencies': client.latencies, 'throughput': total_actions / total_time,
+            'rss': memory.get('VmRSS', 0), 'peak_rss': memory.get('VmHWM', 0)}
+
+
+def print_load(r):
+    print(f"load: {r['users']} users, {r['mode']}, {r['backend']} storage")
+    print(f"  {'action':16} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for action, values in r['latencies'].items():
+        print(f"  {action:16} {len(values):6d} {percentile(values, 50) * 1000:8.1f} "
+              f"{percentile(values, 95) * 1000:8.1f} {percentile(values, 99) * 1000:8.1f}")
+    print(f"  {'phase':16} {'actions':>7} {'sec':>7} {'act/s':>8} {'disk B/act':>11}")
+    for name, actions, elapsed, written in r['phases']:
+        print(f"  {name:16} {actions:7d} {elapsed:7.2f} {actions / elapsed:8.1f} {written / max(actions, 1):11.0f}")
+    print(f"  throughput {r['throughput']:.1f} actions/s, RSS {r['rss'] / 2**20:.1f} MiB "
+          f"(peak {r['peak_rss'] / 2**20:.1f} MiB)")
+
+
+def seed_team(backend, workdir, users, fire):
+    # Команда з розкладом на два місяці; черговий наступного після fire дня має нагадування саме о fire
+    sys.path.insert(0, HERE)
+    from storage import open_store
+    store = open_store(backend, *(os.path.join(workdir, name) for name in ('data.json', 'data.db', 'data.journal')))
+    store.start()
+    uids = [str(10_000 + i) for i in range(users)]
+    for i, uid in enumerate(uids):
+        store.update_user(uid, name=f'User {i}')
+        store.register_user(uid, '🙂', {'hour': 20, 'minute': 0})
+    store.update_user(uids[0], reminder_time={'hour': fire.hour, 'minute': fire.minute})
+    duty = (fire + timedelta(days=1)).date()
+    for key, first in (('schedule_current', duty.replace(day=1)),
+                       ('schedule_next', (duty.replace(day=28) + timedelta(days=4)).replace(day=1))):
+        days = [first + timedelta(days=d) for d in range(31) if (first + timedelta(days=d)).month == first.month]
+        sched = {d.isoformat(): uids[1 + i % (len(uids) - 1)] for i, d in enumerate(days)}
+        if duty in days:
+            sched[duty.isoformat()] = uids[0]
+        store.set_schedule(key, sched)
+    store.close()
+    return uids[0]
+
+
+def bench_startup(users=2000, backend='json', downtime=600):
+    # Час до першої відповіді: холодний старт (індексу нагадувань ще немає) і перезапуск
+    # після простою, під час якого мало спрацювати нагадування - його має бути наздогнано
+    import pytz
+    api = FakeBotApi().start()
+    workdir = tempfile.mkdtemp(prefix='startup-')
+    now = datetime.now(pytz.timezone('Europe/Kyiv')).replace(second=0, microsecond=0)
+    fire = now - timedelta(seconds=downtime / 2)
+    reminded = seed_team(backend, workdir, users, fire)
+    events = {'start': threading.Event(), 'warm': threading.Event(), 'reminder': threading.Event()}
+
+    def on_call(method, chat, params):
+        if chat == 1:
+            events['start'].set()
+        elif str(chat) == reminded and params.get('text', '').startswith('Нагадування'):
+            events['reminder'].set()
+
+    api.listeners.append(on_call)
+    rows = []
+    try:
+        for run in ('cold', 'restart'):
+            if run == 'restart':
+                # останню розіслану хвилину відсунуто на початок простою
+                with open(os.path.join(workdir, 'reminders.state.json'), 'w') as f:
+                    json.dump({'default': (now - timedelta(seconds=downtime)).strftime('%Y-%m-%dT%H:%M')}, f)
+            for event in events.values():
+                event.clear()
+            started = time.perf_counter()
+            bot = start_bot(api, workdir, STORAGE_BACKEND=backend, STARTUP_DEFER='0.5',
+                            REMINDER_GRACE=str(downtime * 2))
+            try:
+                api.push(message_update(1, '/start'))
+                if not events['start'].wait(60):
+                    raise RuntimeError('Bot did not answer')
+                first = time.perf_counter() - started
+                path = os.path.join(workdir, 'reminders.json')
+                saved = os.path.getmtime(path) if os.path.exists(path) else None
+                if run == 'cold':
+                    # індекс збирається зі сховища і зберігається
+                    caught = None
+                    deadline = time.monotonic() + 60
+                    while not os.path.exists(path) and time.monotonic() < deadline:
+                        time.sleep(0.01)
+                else:
+                    # індекс відновлено з файлу, пропущене нагадування розіслано
+                    caught = events['reminder'].wait(30)
+                ready = time.perf_counter() - started
+                rebuilt = saved is not None and os.path.getmtime(path) != saved
+            finally:
+                bot.terminate()
+                bot.wait(10)
+            rows.append({'run': run, 'first_ms': first * 1000, 'ready_ms': ready * 1000, 'caught_up': caught,
+                         'rebuilt': rebuilt})
+    finally:
+        api.stop()
+    return rows
+
+
+# --- Micro-benchmarks ---
+def import_bot():
+    # index.py створює бота, сховище і планувальник при імпорті - ізолюємо їх у тимчасовій теці
+    os.chdir(tempfile.mkdtemp(prefix='micro-'))
+    os.environ.setdefault('TELEGRAM_TOKEN', TOKEN)
+    sys.path.insert(0, HERE)
+    import index
+    return index
+
+
+def timeit(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def bench_micro(sizes):
+    index = import_bot()
+    from teams import DEFAULT_TEAM
+    team = DEFAULT_TEAM
+    store = index.stores.get(team)
+    today = date.today()
+    rows = []
+    for size in sizes:
+        rnd = random.Random(size)
+        users = {}
+        for i in range(size):
+            uid = str(10_000 + i)
+            start = today.replace(day=rnd.randint(1, 25))
+            users[uid] = {'name': f'User {i}', 'emoji': '🙂', 'reminder_time': {'hour': rnd.randint(7, 22), 'minute': 0},
+                          'vacation': [{'from': start.isoformat(), 'to': (start + timedelta(days=rnd.randint(0, 10))).isoformat()}]
+                          if i % 3 else []}
+        for uid, info in users.items():
+            store.update_user(uid, **info)
+        sched = index.generate_schedule(today.year, today.month, users)
+        store.set_schedule('schedule_current', sched)
+        rows.append((size,
+                     timeit(lambda: index.generate_schedule(today.year, today.month, users)),
+                     timeit(lambda: index.format_schedule(sched, users, today.year, today.month)),
+                     timeit(lambda: index.schedule_text(team, 'schedule_current', today.year, today.month)),
+                     timeit(lambda: index.schedule_reminders(team))))
+    print(f"{'users':>7} {'generate ms':>12} {'format ms':>10} {'cached ms':>10} {'reminders ms':>13}")
+    for size, gen, fmt, cached, rem in rows:
+        print(f"{size:7d} {gen * 1000:12.2f} {fmt * 1000:10.2f} {cached * 1000:10.3f} {rem * 1000:13.2f}")
+    if index.scheduler is not None:
+        index.scheduler.shutdown(wait=False)
+
+
+def bench_import(users, vacations, backend):
+    # Онбординг відділу: CSV профілів + JSONL відпусток -> одна транзакція і одна перегенерація
+    os.environ['STORAGE_BACKEND'] = backend
+    index = import_bot()
+    import bulk
+    from teams import DEFAULT_TEAM
+    rnd = random.Random(users)
+    first = date.today().replace(day=1)
+    with open('users.csv', 'w', encoding='utf-8') as f:
+        f.write('uid,name,emoji,reminder\n')
+        for i in range(users):
+            f.write(f'{10_000 + i},User {i},🙂,{7 + i % 14:02d}:00\n')
+    with open('vacations.jsonl', 'w', encoding='utf-8') as f:
+        for i in range(vacations):
+            start = first + timedelta(days=rnd.randint(0, 50))
+            f.write(json.dumps({'uid': str(10_000 + i % users), 'from': start.isoformat(),
+                                'to': (start + timedelta(days=rnd.randint(0, 10))).isoformat()}) + '\n')
+    before = proc_stats(os.getpid())['write_bytes']
+    started = time.perf_counter()
+    imported = index.import_roster(DEFAULT_TEAM, bulk.open_rows(['users.csv', 'vacations.jsonl']))
+    index.stores.get(DEFAULT_TEAM).flush()
+    elapsed = time.perf_counter() - started
+    written = proc_stats(os.getpid())['write_bytes'] - before
+    export = timeit(lambda: sum(len(c) for c in bulk.export_month(index.stores.get(DEFAULT_TEAM),
+                                                                  index.month_key('current'))))
+    index.stores.close()
+    return {'backend': backend, 'rows': users + vacations, 'users': imported[0], 'vacations': imported[1],
+            'sec': elapsed, 'written': written, 'export_ms': export * 1000}
+
+
+def bench_market(offers=5000, users=500, take=3, any_share=0.05, window=30, backend='json'):
+    # 1) Сама книга: потік пропозицій по "довгому" розкладу (слот = день), кожна одразу шукає
+    #    пару чи ланцюг до трьох; поруч - наївний пошук пари повним переглядом усіх пропозицій.
+    # 2) Повний шлях index.post_offer: сховище, угода однією транзакцією, нагадування
+    sys.path.insert(0, HERE)
+    from market import OfferBook, Offer, moves
+    rnd = random.Random(offers)
+    slots = [(date(2000, 1, 1) + timedelta(days=i)).isoformat() for i in range(offers)]
+    stream = []
+    for i in range(offers):
+        slot = rnd.randrange(offers)
+        near = [slots[j] for j in rnd.sample(range(max(0, slot - window), min(offers, slot + window + 1)), take)]
+        stream.append((str(i), slots[slot], None if rnd.random() < any_share else frozenset(near) - {slots[slot]}))
+
+    def run(match):
+        holders = {iso: str(rnd_users.randrange(users)) for iso in slots}
+        book, found, times = OfferBook(), Counter(), []
+        valid = lambda taker, giver: (holders[giver.give] == giver.uid and holders[taker.give] == taker.uid
+                                      and taker.uid != giver.uid)
+        for oid, give, wants in stream:
+            book.add(Offer(oid, holders[give], 'schedule_current', give, wants, 0))
+            t = time.perf_counter()
+            cycle = match(book, oid, valid)
+            times.append(time.perf_counter() - t)
+            if cycle:
+                found[len(cycle)] += 1
+                for _, iso, _, taker in moves(cycle):
+                    holders[iso] = taker
+                    for stale in list(book.by_give.get(iso, ())):
+                        book.remove(stale)
+        return found, times, len(book)
+
+    def naive(book, oid, valid):
+        new = book.offers[oid]
+        for other in list(book.offers.values()):
+            if other.oid != oid and (new.take is None or other.give in new.take) and \
+                    (other.take is None or new.give in other.take) and valid(new, other) and valid(other, new):
+                return [new, other]
+        return None
+
+    rows = []
+    for name, match in (('indexed', lambda book, oid, valid: book.find_cycle(oid, valid, 3)), ('scan', naive)):
+        rnd_users = random.Random(users)
+        started = time.perf_counter()
+        found, times, left = run(match)
+        elapsed = time.perf_counter() - started
+        rows.append({'matcher': name, 'offers_per_sec': offers / elapsed, 'pairs': found[2], 'cycles': found[3],
+                     'open': left, 'p50_us': percentile(times, 50) * 1e6, 'p99_us': percentile(times, 99) * 1e6})
+
+    os.environ['STORAGE_BACKEND'] = backend
+    index = import_bot()
+    from teams import DEFAULT_TEAM
+    team = DEFAULT_TEAM
+    store = index.stores.get(team)
+    for i in range(30):
+        store.update_user(str(1000 + i), name=f'User {i}')
+        store.register_user(str(1000 + i), '🙂', {'hour': 20, 'minute': 0})
+    index.regenerate(team)
+    today = datetime.now().date().isoformat()
+    trades = Counter()
+    posts = min(offers, 2000)
+    started = time.perf_counter()
+    for _ in range(posts):
+        key = rnd.choice(['schedule_current', 'schedule_next'])
+        duties = [(iso, uid) for k in ('schedule_current', 'schedule_next')
+                  for iso, uid in store.schedule(k).items() if iso > today]
+        give, uid = rnd.choice([d for d in duties if d[0] in store.schedule(key)] or duties)
+        wants = [iso for iso, holder in rnd.sample(duties, min(take, len(duties))) if holder != uid]
+        key = 'schedule_current' if give in store.schedule('schedule_current') else 'schedule_next'
+        _, cycle = index.post_offer(team, uid, key, give, wants or None)
+        if cycle:
+            trades[len(cycle)] += 1
+    elapsed = time.perf_counter() - started
+    rows.append({'matcher': f'post_offer/{backend}', 'offers_per_sec': posts / elapsed, 'pairs': trades[2],
+                 'cycles': trades[3], 'open': len(store.offers()), 'p50_us': 0.0, 'p99_us': 0.0})
+    index.outbox.close()
+    index.stores.close()
+    return rows
+
+
+def bench_stress(backend, threads, ops):
+    # Тисячі одночасних реєстрацій, оновлень профілю і обмінів; жодна зміна не має загубитися
+    sys.path.insert(0, HERE)
+    from storage import open_store, Conflict, MISSING
+    workdir = tempfile.mkdtemp(prefix='stress-')
+    paths = (os.path.join(workdir, 'data.json'), os.path.join(workdir, 'data.db'))
+    store = open_store(backend, *paths, flush_interval=0.05)
+    store.start()
+    seed = [str(i) for i in range(10)]
+    for uid in seed:
+        store.update_user(uid, name=f'Seed {uid}')
+        store.register_user(uid, '🙂', {'hour': 20, 'minute': 0})
+    days = [(date(2026, 1, 1) + timedelta(days=d)).isoformat() for d in range(31)]
+    store.set_schedule('schedule_current', {iso: seed[i % len(seed)] for i, iso in enumerate(days)})
+    before = Counter(store.schedule('schedule_current').values())
+    hits = Counter()
+    stats = Counter()
+    lock = threading.Lock()
+
+    def worker(n):
+        rnd = random.Random(n)
+        local_hits, local_stats = Counter(), Counter()
+        for i in range(ops):
+            kind = i % 3
+            if kind == 0:
+                uid = f'{n}-{i}'
+                store.update_user(uid, name=f'User {uid}')
+                store.register_user(uid, '⭐', {'hour': 9, 'minute': 0})
+                local_stats['registered'] += 1
+            elif kind == 1:
+                # Пауза між читанням і записом, як у хендлера, що встиг щось надіслати:
+                # паралельні оновлення мусять ловити Conflict і повторювати, а не губитися
+                uid, calls = rnd.choice(seed), []
+
+                def bump(u):
+                    calls.append(1)
+                    time.sleep(0.001)
+                    return {'hits': u.get('hits', 0) + 1}
+                # Оптимістичне оновлення, як у хендлерах: expected - зі знімка до bump()
+                while True:
+                    seen = store.get_user(uid)
+                    fields = bump(dict(seen))
+                    try:
+                        store.update_user(uid, expected={'hits': seen.get('hits', MISSING)}, **fields)
+                        break
+                    except Conflict:
+                        pass
+                local_stats['conflicts'] += len(calls) - 1
+                local_hits[uid] += 1
+            else:
+                fr, to_dt = rnd.sample(days, 2)
+                for _ in range(20):
+                    a, b = store.on_duty('schedule_current', fr), store.on_duty('schedule_current', to_dt)
+                    if a == b:
+                        break
+                    try:
+                        store.swap('schedule_current', fr, to_dt, a, b)
+                        local_stats['swapped'] += 1
+                        break
+                    except Conflict:
+                        local_stats['conflicts'] += 1
+        with lock:
+            hits.update(local_hits)
+            stats.update(local_stats)
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    store.close()
+
+    reopened = open_store(backend, *paths)
+    users = reopened.users()
+    errors = []
+    missing = [f'{n}-{i}' for n in range(threads) for i in range(0, ops, 3)
+               if users.get(f'{n}-{i}', {}).get('emoji') != '⭐']
+    if missing:
+        errors.append(f'{len(missing)} registrations lost')
+    lost_hits = {uid: hits[uid] - users[uid].get('hits', 0) for uid in seed if users[uid].get('hits', 0) != hits[uid]}
+    if lost_hits:
+        errors.append(f'profile updates lost: {lost_hits}')
+    if Counter(reopened.schedule('schedule_current').values()) != before:
+        errors.append('swaps lost or duplicated duties')
+    reopened.close()
+    return {'backend': backend, 'ops': threads * ops, 'ops_per_sec': threads * ops / elapsed,
+            'swapped': stats['swapped'], 'conflicts': stats['conflicts'], 'errors': errors}
+
+
+def failover_worker(db, out, ttl):
+    # Учасник виборів: поки лідер, кожні 50 мс "розсилає" тік - як dispatch_reminders через claim()
+    sys.path.insert(0, HERE)
+    from cluster import Lease, LeaderElection
+    lease = Lease(db, ttl=ttl)
+    state = {'leader': False}
+    election = LeaderElection(lease, lambda: state.update(leader=True), lambda: state.update(leader=False))
+    election.start()
+    with open(out, 'a') as f:
+        while True:
+            if state['leader']:
+                tick = int(time.time() * 10)
+                if lease.claim(f'tick:{tick}'):
+                    f.write(f'{tick}\n')
+                    f.flush()
+            time.sleep(0.05)
+
+
+def bench_failover(procs=3, ttl=1.0, duration=6.0):
+    # Вбиваємо лідера посеред роботи: хтось інший має підхопити за ~ttl, і жоден тік не розіслано двічі
+    import sqlite3
+    import multiprocessing
+    workdir = tempfile.mkdtemp(prefix='failover-')
+    db = os.path.join(workdir, 'cluster.db')
+    ctx = multiprocessing.get_context('spawn')
+    outs = [os.path.join(workdir, f'ticks-{i}') for i in range(procs)]
+    pool = [ctx.Process(target=failover_worker, args=(db, out, ttl), daemon=True) for out in outs]
+    for proc in pool:
+        proc.start()
+    time.sleep(duration / 2)
+    holder = sqlite3.connect(db).execute('SELECT holder FROM leases').fetchone()[0]
+    victim = next(proc for proc in pool if holder.endswith(f':{proc.pid}'))
+    killed_at = int(time.time() * 10)
+    victim.kill()
+    time.sleep(duration / 2)
+    for proc in pool:
+        proc.kill()
+    ticks = []
+    for out in outs:
+        with open(out) as f:
+            ticks += [int(line) for line in f if line.strip()]
+    unique = sorted(set(ticks))
+    after = [t for t in unique if t > killed_at]
+    gaps = [b - a for a, b in zip(unique, unique[1:])]
+    return {'procs': procs, 'ttl': ttl, 'ticks': len(unique), 'duplicates': len(ticks) - len(unique),
+            'takeover_sec': (after[0] - killed_at) / 10 if after else None, 'max_gap_sec': max(gaps, default=0) / 10}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the duty bot')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    ingest = sub.add_parser('ingest', help='per-update latency and throughput for polling vs webhook')
+    ingest.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+    ingest.add_argument('--users', type=int, default=20)
+    ingest.add_argument('--per-user', type=int, default=50)
+    stress = sub.add_parser('stress', help='concurrent swaps/registrations; checks that no update is lost')
+    stress.add_argument('--backend', choices=['json', 'sqlite', 'both'], default='both')
+    stress.add_argument('--threads', type=int, default=32)
+    stress.add_argument('--ops', type=int, default=300)
+    load = sub.add_parser('load', help='synthetic users through registration, vacations and the exchange flow')
+    load.add_argument('--users', type=int, default=50)
+    load.add_argument('--mode', choices=['polling', 'webhook', 'cluster'], default='polling')
+    load.add_argument('--workers', type=int, default=2, help='worker processes for --mode cluster')
+    load.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    failover = sub.add_parser('failover', help='kill the scheduler leader; measure takeover and duplicate sends')
+    failover.add_argument('--procs', type=int, default=3)
+    failover.add_argument('--ttl', type=float, default=1.0)
+    startup = sub.add_parser('startup', help='time to first response on cold start and restart; reminder catch-up')
+    startup.add_argument('--users', type=int, default=2000)
+    startup.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    imp = sub.add_parser('import', help='bulk CSV/JSONL import: one transaction and one regeneration')
+    imp.add_argument('--users', type=int, default=10000)
+    imp.add_argument('--vacations', type=int, default=10000)
+    imp.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    market = sub.add_parser('market', help='swap-market matching throughput: indexed matcher vs full scan')
+    market.add_argument('--offers', type=int, default=5000)
+    market.add_argument('--users', type=int, default=500)
+    market.add_argument('--take', type=int, default=3, help='dates each offer is willing to take')
+    market.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    micro = sub.add_parser('micro', help='generate_schedule / format_schedule / schedule_reminders by team size')
+    micro.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    args = parser.parse_args()
+
+    if args.cmd == 'ingest':
+        modes = ['polling', 'webhook'] if args.mode == 'both' else [args.mode]
+        for mode in modes:
+            r = bench_ingest(mode, args.users, args.per_user)
+            print(f"{r['mode']:8} {r['updates']:6d} updates  {r['updates_per_sec']:8.1f} upd/s  "
+                  f"p50 {r['p50_ms']:.1f} ms  p95 {r['p95_ms']:.1f} ms  p99 {r['p99_ms']:.1f} ms")
+
+    elif args.cmd == 'load':
+        print_load(bench_load(args.users, args.mode, args.backend, args.workers))
+    elif args.cmd == 'startup':
+        rows = bench_startup(args.users, args.backend)
+        for r in rows:
+            print(f"{r['run']:8} first response {r['first_ms']:7.1f} ms  reminders ready {r['ready_ms']:7.1f} ms"
+                  + ('' if r['caught_up'] is None else f"  missed reminder {'sent' if r['caught_up'] else 'LOST'}")
+                  + ('  (index rebuilt)' if r['rebuilt'] else ''))
+        sys.exit(0 if rows[-1]['caught_up'] else 1)
+    elif args.cmd == 'import':
+        r = bench_import(args.users, args.vacations, args.backend)
+        print(f"{r['backend']:6} {r['rows']} rows in {r['sec']:.2f} s ({r['rows'] / r['sec']:.0f} rows/s): "
+              f"{r['users']} users, {r['vacations']} vacations, {r['written'] / 1024:.0f} KiB written; "
+              f"month export {r['export_ms']:.2f} ms")
+    elif args.cmd == 'market':
+        print(f"{'matcher':18} {'offers/s':>9} {'pairs':>6} {'3-cycles':>9} {'open':>6} {'p50 us':>8} {'p99 us':>8}")
+        for r in bench_market(args.offers, args.users, args.take, backend=args.backend):
+            print(f"{r['matcher']:18} {r['offers_per_sec']:9.0f} {r['pairs']:6d} {r['cycles']:9d} {r['open']:6d} "
+                  f"{r['p50_us']:8.1f} {r['p99_us']:8.1f}")
+    elif args.cmd == 'micro':
+        bench_micro(args.sizes)
+    elif args.cmd == 'failover':
+        r = bench_failover(args.procs, args.ttl)
+        print(f"{r['procs']} processes, lease ttl {r['ttl']}s: {r['ticks']} ticks, {r['duplicates']} duplicates, "
+              f"takeover {r['takeover_sec']}s (max gap {r['max_gap_sec']}s)")
+        sys.exit(1 if r['duplicates'] or r['takeover_sec'] is None else 0)
+    elif args.cmd == 'stress':
+        backends = ['json', 'sqlite'] if args.backend == 'both' else [args.backend]
+        failed = False
+        for backend in backends:
+            r = bench_stress(backend, args.threads, args.ops)
+            print(f"{r['backend']:6} {r['ops']:6d} ops  {r['ops_per_sec']:8.1f} ops/s  "
+                  f"{r['swapped']} swaps  {r['conflicts']} conflicts retried  "
+                  f"{'OK' if not r['errors'] else 'FAIL: ' + '; '.join(r['errors'])}")
+            failed = failed or bool(r['errors'])
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import io
+import os
+import re
+import csv
+import sys
+import json
+import argparse
+from datetime import date, datetime, timedelta, timezone
+
+UID = re.compile(r'\d+')
+HHMM = re.compile(r'(\d{1,2}):(\d{2})')
+
+
+# --- Import ---
+# Файли читаються рядок за рядком: CSV з заголовком або JSONL з тими самими ключами.
+# Рядок з name/emoji/reminder оновлює профіль, з from/to - додає відпустку (можна обидва разом),
+# тож і "uid,name,emoji,reminder", і "uid,from,to" - коректні файли
+def read_records(stream, fmt):
+    if fmt == 'jsonl':
+        for n, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    yield n, json.loads(line)
+                except ValueError:
+                    raise ValueError(f'line {n}: not a JSON object')
+    else:
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+
+
+def parse_row(record):
+    # -> (uid, поля профілю, відпустка або None)
+    value = lambda key: str(record.get(key) or '').strip()
+    uid = value('uid')
+    if not UID.fullmatch(uid):
+        raise ValueError(f'bad uid {uid!r}')
+    fields = {}
+    if value('name'):
+        fields['name'] = value('name')
+    if value('emoji'):
+        fields['emoji'] = value('emoji')
+    if value('reminder'):
+        m = HHMM.fullmatch(value('reminder'))
+        if not m or int(m[1]) > 23 or int(m[2]) > 59:
+            raise ValueError(f'bad reminder time {value("reminder")!r}, expected HH:MM')
+        fields['reminder_time'] = {'hour': int(m[1]), 'minute': int(m[2])}
+    vac = None
+    if value('from') or value('to'):
+        try:
+            start, end = date.fromisoformat(value('from')), date.fromisoformat(value('to'))
+        except ValueError:
+            raise ValueError(f'bad vacation {value("from")!r}..{value("to")!r}, expected YYYY-MM-DD')
+        if start > end:
+            raise ValueError(f'vacation ends before it starts: {start}..{end}')
+        vac = {'from': start.isoformat(), 'to': end.isoformat()}
+    if not fields and vac is None:
+        raise ValueError('nothing to import: no profile fields and no vacation')
+    return uid, fields, vac
+
+
+def parse_rows(stream, fmt, source='-'):
+    for n, record in read_records(stream, fmt):
+        try:
+            yield parse_row(record)
+        except ValueError as e:
+            raise ValueError(f'{source}:{n}: {e}')
+
+
+def detect_format(name):
+    return 'jsonl' if name.lower().endswith(('.jsonl', '.json', '.ndjson')) else 'csv'
+
+
+def open_rows(paths):
+    # Рядки з кількох файлів підряд; кожен файл відкривається лише коли до нього дійшла черга
+    for path in paths:
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            yield from parse_rows(f, detect_format(path), path)
+
+
+# --- Export ---
+def export_month(store, month, chunk_rows=500):
+    # CSV розкладу за місяць 'YYYY-MM', шматками по chunk_rows рядків
+    users = {}  # лише ті, хто чергує цього місяця, а не весь склад команди
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['date', 'uid', 'name', 'emoji'])
+    for n, (iso, uid) in enumerate(store.month_duties(month), 1):
+        if uid not in users:
+            users[uid] = store.get_user(uid) or {}
+        info = users[uid]
+        writer.writerow([iso, uid, info.get('name', ''), info.get('emoji', '')])
+        if n % chunk_rows == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def ical_feed(store, uid, calendar='Чергування'):
+    # iCalendar (RFC 5545) з чергуваннями користувача: подія на цілий день
+    # і сповіщення в його час нагадування напередодні
+    info = store.get_user(uid) or {}
+    rt = info.get('reminder_time') or {'hour': 20, 'minute': 0}
+    before = 24 * 60 - rt['hour'] * 60 - rt['minute']
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    yield ('BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//duty-bot//UK\r\nCALSCALE:GREGORIAN\r\n'
+           f'X-WR-CALNAME:{calendar}\r\n')
+    for key in ('schedule_current', 'schedule_next'):
+        for iso in store.user_dates(key, uid):
+            day = date.fromisoformat(iso)
+            yield ('BEGIN:VEVENT\r\n'
+                   f'UID:{iso}-{uid}@duty-bot\r\n'
+                   f'DTSTAMP:{stamp}\r\n'
+                   f'DTSTART;VALUE=DATE:{day:%Y%m%d}\r\n'
+                   f'DTEND;VALUE=DATE:{day + timedelta(days=1):%Y%m%d}\r\n'
+                   f'SUMMARY:{calendar}\r\n'
+                   'BEGIN:VALARM\r\nACTION:DISPLAY\r\nDESCRIPTION:Завтра чергування\r\n'
+                   f'TRIGGER:-PT{before}M\r\nEND:VALARM\r\n'
+                   'END:VEVENT\r\n')
+    yield 'END:VCALENDAR\r\n'
+
+
+# Адмінські операції без бота: python bulk.py import|export|ical --team <id> ...
+# З JSON-сховищем бот на час імпорту треба зупинити (дані в пам'яті його процесу);
+# з SQLite можна й наживо - бот підхопить зміни при перезапуску або через sync_reminders
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import/export of duty rosters')
+    parser.add_argument('--team', default='default')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    imp = sub.add_parser('import', help='users and vacations from CSV/JSONL, then one schedule regeneration')
+    imp.add_argument('files', nargs='+')
+    imp.add_argument('--no-generate', action='store_true', help='keep existing schedules')
+    exp = sub.add_parser('export', help='one month of the schedule as CSV')
+    exp.add_argument('month', help='YYYY-MM, "current" or "next"')
+    cal = sub.add_parser('ical', help="a user's duties as an iCalendar feed")
+    cal.add_argument('uid')
+    args = parser.parse_args()
+    os.environ.setdefault('TELEGRAM_TOKEN', '0:offline')
+    import index
+    try:
+        if args.cmd == 'import':
+            try:
+                users, vacations = index.import_roster(args.team, open_rows(args.files),
+                                                       generate=not args.no_generate)
+            except ValueError as e:
+                sys.exit(f'Import failed, nothing written: {e}')
+            print(f'Imported {users} users and {vacations} vacations into team {args.team}')
+        elif args.cmd == 'export':
+            for chunk in export_month(index.stores.get(args.team), index.month_key(args.month)):
+                sys.stdout.write(chunk)
+        else:
+            for chunk in ical_feed(index.stores.get(args.team), args.uid):
+                sys.stdout.write(chunk)
+    finally:
+        index.outbox.close()
+        index.stores.close()
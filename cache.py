@@ -0,0 +1,36 @@
+import threading
+from collections import OrderedDict
+from metrics import registry
+
+
+# Готові до відправки відображення: текст розкладу, JSON інлайн-клавіатур.
+# Поруч із кожним записом лежать версії даних, з яких його зібрано; якщо версії
+# в сховищі вже інші - запис перебудовується. Понад max_entries витісняються
+# найдавніше використані, тож пам'ять обмежена незалежно від кількості користувачів
+class RenderCache:
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self.items = OrderedDict()  # key -> (versions, value)
+        self.lock = threading.Lock()
+
+    def get(self, key, versions, build):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[0] == versions:
+                self.items.move_to_end(key)
+                hit = True
+            else:
+                hit = False
+        registry.inc('render_cache_total', result='hit' if hit else 'miss')
+        if hit:
+            return item[1]
+        value = build()
+        with self.lock:
+            self.items[key] = (versions, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import logging
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from sqlitedb import LocalConnection, transaction
+
+logger = logging.getLogger(__name__)
+
+LEASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS claims (
+    key TEXT PRIMARY KEY,
+    ts REAL NOT NULL
+);
+"""
+
+
+# Оренда в SQLite замість окремого сервісу координації: хто тримає непротухлий запис,
+# той лідер. Лідер поновлює оренду кожні ttl/3 секунд; якщо процес помер, через ttl
+# оренду забирає інший. claim() - одноразова позначка, щоб задачу (нагадування на певну
+# хвилину) виконав рівно один процес навіть на межі перевиборів
+class Lease:
+    def __init__(self, path, name='scheduler', ttl=15.0):
+        self.path = path
+        self.name = name
+        self.ttl = ttl
+        self.holder = f'{socket.gethostname()}:{os.getpid()}'
+        self._db = LocalConnection(path)
+        self.conn.executescript(LEASE_SCHEMA)
+
+    @property
+    def conn(self):
+        return self._db.get()
+
+    def acquire(self):
+        # Взяти або поновити оренду; False, якщо її тримає інший живий процес
+        now = time.time()
+        with transaction(self.conn) as conn:
+            row = conn.execute('SELECT holder, expires FROM leases WHERE name = ?', (self.name,)).fetchone()
+            if row is None or row[0] == self.holder or row[1] < now:
+                conn.execute('INSERT OR REPLACE INTO leases (name, holder, expires) VALUES (?, ?, ?)',
+                             (self.name, self.holder, now + self.ttl))
+                conn.execute('DELETE FROM claims WHERE ts < ?', (now - 7 * 86400,))
+                return True
+            return False
+
+    def release(self):
+        self.conn.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (self.name, self.holder))
+
+    def claim(self, key):
+        return self.conn.execute('INSERT OR IGNORE INTO claims (key, ts) VALUES (?, ?)',
+                                 (key, time.time())).rowcount == 1
+
+
+class LeaderElection:
+    def __init__(self, lease, on_elected, on_demoted):
+        self.lease = lease
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.leader = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='leader-election', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self.leader:
+            self.leader = False
+            self.on_demoted()
+            self.lease.release()
+
+    def _loop(self):
+        while True:
+            try:
+                leader = self.lease.acquire()
+            except sqlite3.Error:
+                logger.exception('Lease renewal failed')
+                leader = False
+            if leader != self.leader:
+                self.leader = leader
+                logger.info('%s %s scheduler leadership', self.lease.holder, 'took' if leader else 'lost')
+                (self.on_elected if leader else self.on_demoted)()
+            if self._stop.wait(self.lease.ttl / 3):
+                return
+
+
+# --- Workers ---
+def worker_main(n, workers, q, parent):
+    # Кожен воркер - повноцінний бот зі своїми потоками хендлерів; стан спільний через SQLite.
+    # Планувальник стоїть на паузі, поки цей процес не стане лідером
+    os.environ['CLUSTER_WORKER'] = str(n)
+    os.environ['CLUSTER_WORKERS'] = str(workers)
+    from telebot import types
+    import index
+    import metrics
+    if index.METRICS_PORT:
+        metrics.serve(index.METRICS_PORT + 1 + n)
+    election = LeaderElection(index.lease, index.become_leader, index.step_down)
+    election.start()
+    try:
+        while True:
+            try:
+                raw = q.get(timeout=1)
+            except queue.Empty:
+                if os.getppid() != parent:
+                    break  # диспетчер загинув, не лишатися сиротою
+                continue
+            if raw is None:
+                break
+            index.bot.process_new_updates([types.Update.de_json(raw)])
+    finally:
+        election.stop()
+        index.outbox.close()
+        index.conversations.save()
+        index.stores.close()
+
+
+def chat_of(update):
+    # Усі оновлення одного чату - в один воркер: там його next-step хендлери і порядок повідомлень
+    for kind in ('message', 'edited_message', 'callback_query'):
+        obj = update.get(kind)
+        if obj:
+            return int(obj['from']['id'] if kind == 'callback_query' else obj['chat']['id'])
+    return update['update_id']
+
+
+# --- Dispatcher ---
+# Один процес тягне оновлення з Bot API і розкладає їх по N воркерах; воркер, що впав,
+# перезапускається з тією ж чергою, тож його чати не губляться
+def run_cluster(workers, token, api_url=None, queue_size=1000):
+    from telebot import apihelper
+    if api_url:
+        apihelper.API_URL = api_url
+    ctx = multiprocessing.get_context('spawn')
+    queues = [ctx.Queue(queue_size) for _ in range(workers)]
+    procs = [None] * workers
+
+    def spawn(i):
+        procs[i] = ctx.Process(target=worker_main, args=(i, workers, queues[i], os.getpid()),
+                               name=f'bot-worker-{i}')
+        procs[i].start()
+
+    for i in range(workers):
+        spawn(i)
+    offset = None
+    try:
+        while True:
+            try:
+                updates = apihelper.get_updates(token, offset=offset, timeout=25, long_polling_timeout=20)
+            except Exception:
+                logger.exception('getUpdates failed')
+                time.sleep(1)
+                updates = []
+            for update in updates:
+                offset = update['update_id'] + 1
+                queues[chat_of(update) % workers].put(json.dumps(update))
+            for i, proc in enumerate(procs):
+                if not proc.is_alive():
+                    logger.warning('Worker %d exited with %s, restarting', i, proc.exitcode)
+                    spawn(i)
+    finally:
+        for q in queues:
+            q.put(None)
+        for proc in procs:
+            proc.join(timeout=15)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Run the bot as a dispatcher with several worker processes')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('CLUSTER_WORKERS', os.cpu_count() or 2)))
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # щоб finally зупинив воркерів
+    if os.getenv('STORAGE_BACKEND', 'json') != 'sqlite':
+        sys.exit('Cluster mode needs STORAGE_BACKEND=sqlite: workers share state only through the database')
+    run_cluster(args.workers, os.getenv('TELEGRAM_TOKEN', '***'), os.getenv('TELEGRAM_API_URL'))
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from storage import atomic_write
+from sqlitedb import LocalConnection, transaction
+
+
+# Тимчасовий стан діалогів (недозаповнена відпустка, кроки обміну, запити на обмін).
+# Живе лише в пам'яті: записи протухають через ttl секунд, а понад max_entries
+# витісняються найдавніше використані. На диск - лише за бажанням, для перезапуску
+class ConversationStore:
+    def __init__(self, ttl=3600, max_entries=10000, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.items = OrderedDict()  # (chat, key) -> (expires_at, value)
+        self.lock = threading.Lock()
+
+    def _alive(self, item_key, now):
+        item = self.items.get(item_key)
+        if item is None:
+            return None
+        if item[0] <= now:
+            del self.items[item_key]
+            return None
+        self.items.move_to_end(item_key)
+        return item
+
+    def get(self, chat, key, default=None):
+        with self.lock:
+            item = self._alive((str(chat), key), time.time())
+            return default if item is None else item[1]
+
+    def set(self, chat, key, value, ttl=None):
+        with self.lock:
+            item_key = (str(chat), key)
+            self.items[item_key] = (time.time() + (ttl or self.ttl), value)
+            self.items.move_to_end(item_key)
+            while len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+
+    def pop(self, chat, key, default=None):
+        with self.lock:
+            item = self._alive((str(chat), key), time.time())
+            if item is None:
+                return default
+            del self.items[(str(chat), key)]
+            return item[1]
+
+    def modify(self, chat, key, change):
+        # Атомарно змінює наявне значення; None, якщо стану вже немає (протух або скасований)
+        with self.lock:
+            item = self._alive((str(chat), key), time.time())
+            if item is None:
+                return None
+            value = change(item[1])
+            self.items[(str(chat), key)] = (item[0], value)
+            return value
+
+    def clear(self, chat, *keys):
+        with self.lock:
+            for key in keys:
+                self.items.pop((str(chat), key), None)
+
+    def count(self, key):
+        # key і його підключі 'key:...' (напр. окремі запити на обмін 'exchange:<дата>')
+        now = time.time()
+        with self.lock:
+            return sum(1 for (_, k), (expires, _) in self.items.items()
+                       if (k == key or k.startswith(key + ':')) and expires > now)
+
+    def purge(self):
+        now = time.time()
+        with self.lock:
+            for item_key in [k for k, (expires, _) in self.items.items() if expires <= now]:
+                del self.items[item_key]
+
+    def __len__(self):
+        return len(self.items)
+
+    # --- Optional persistence ---
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            rows = json.load(f)
+        now = time.time()
+        with self.lock:
+            for chat, key, expires, value in rows:
+                if expires > now:
+                    self.items[(chat, key)] = (expires, value)
+
+    def save(self):
+        if not self.path:
+            return
+        self.purge()
+        with self.lock:
+            rows = [[chat, key, expires, value] for (chat, key), (expires, value) in self.items.items()]
+        atomic_write(self.path, json.dumps(rows, ensure_ascii=False).encode('utf-8'))
+
+
+# Той самий інтерфейс, але стан у спільній SQLite-базі: потрібен, коли бот працює
+# кількома процесами і крок обміну може потрапити до іншого процесу, ніж попередній
+class SqliteConversationStore:
+    def __init__(self, path, ttl=3600, max_entries=10000, purge_every=200):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.purge_every = purge_every  # воркери живуть довго: чистити по ходу, а не лише в save()
+        self.writes = 0
+        self._db = LocalConnection(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS conversations (chat TEXT NOT NULL, key TEXT NOT NULL, '
+                          'expires REAL NOT NULL, value TEXT NOT NULL, PRIMARY KEY (chat, key))')
+
+    @property
+    def conn(self):
+        return self._db.get()
+
+    def _select(self, chat, key):
+        return self.conn.execute('SELECT value FROM conversations WHERE chat = ? AND key = ? AND expires > ?',
+                                 (str(chat), key, time.time())).fetchone()
+
+    def get(self, chat, key, default=None):
+        row = self._select(chat, key)
+        return default if row is None else json.loads(row[0])
+
+    def set(self, chat, key, value, ttl=None):
+        self.conn.execute('INSERT OR REPLACE INTO conversations (chat, key, expires, value) VALUES (?, ?, ?, ?)',
+                          (str(chat), key, time.time() + (ttl or self.ttl), json.dumps(value, ensure_ascii=False)))
+        self.writes += 1
+        if self.writes % self.purge_every == 0:
+            self.purge()
+
+    def pop(self, chat, key, default=None):
+        # DELETE ... RETURNING атомарний: лише один процес отримає запит на обмін
+        row = self.conn.execute('DELETE FROM conversations WHERE chat = ? AND key = ? RETURNING expires, value',
+                                (str(chat), key)).fetchone()
+        if row is None or row[0] <= time.time():
+            return default
+        return json.loads(row[1])
+
+    def modify(self, chat, key, change):
+        with transaction(self.conn) as conn:
+            row = self._select(chat, key)
+            value = None
+            if row is not None:
+                value = change(json.loads(row[0]))
+                conn.execute('UPDATE conversations SET value = ? WHERE chat = ? AND key = ?',
+                             (json.dumps(value, ensure_ascii=False), str(chat), key))
+            return value
+
+    def clear(self, chat, *keys):
+        self.conn.executemany('DELETE FROM conversations WHERE chat = ? AND key = ?', [(str(chat), k) for k in keys])
+
+    def count(self, key):
+        return self.conn.execute('SELECT COUNT(*) FROM conversations WHERE (key = ? OR key LIKE ?) AND expires > ?',
+                                 (key, key + ':%', time.time())).fetchone()[0]
+
+    def purge(self):
+        # Протухлі записи, а понад max_entries - ті, що протухнуть найраніше
+        conn = self.conn
+        conn.execute('DELETE FROM conversations WHERE expires <= ?', (time.time(),))
+        conn.execute('DELETE FROM conversations WHERE rowid IN (SELECT rowid FROM conversations '
+                     'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM conversations WHERE expires > ?', (time.time(),)).fetchone()[0]
+
+    def load(self):
+        pass  # стан уже на диску
+
+    def save(self):
+        self.purge()
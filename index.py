@@ -1,35 +1,184 @@
+import io
 import os
+import re
 import json
+import sys
+import time
+import heapq
+import signal
+import threading
 import calendar
-from datetime import datetime, timedelta, date
+from contextlib import nullcontext
+from datetime import datetime, timedelta, date, timezone
 import pytz
-from telebot import TeleBot, types
-from apscheduler.schedulers.background import BackgroundScheduler
+from telebot import TeleBot, types, apihelper
+from storage import Conflict, atomic_write
+from teams import TeamStores, TeamDirectory
+from outbox import Outbox
+from conversations import ConversationStore, SqliteConversationStore
+from cache import RenderCache
+from market import OfferBook, Offer, offer_from_dict, moves
+import bulk
+import metrics
+from metrics import registry
 
 # --- Configurations ---
 TOKEN = os.getenv('TELEGRAM_TOKEN', '***')
 DATA_FILE = 'data.json'
+JOURNAL_FILE = 'data.journal'
+DB_FILE = 'data.db'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')  # json | sqlite
 DEFAULT_REMINDER_TIME = {'hour': 20, 'minute': 0}
+IMPORT_DEFAULTS = {'emoji': '🙂', 'reminder_time': DEFAULT_REMINDER_TIME}  # для нових людей з імпорту
+ADMIN_IDS = {uid.strip() for uid in os.getenv('ADMIN_IDS', '').split(',') if uid.strip()}  # /import, /export
 TIMEZONE = 'Europe/Kyiv'
+API_URL = os.getenv('TELEGRAM_API_URL')  # напр. http://127.0.0.1:8081/bot{0}/{1} для локального фейкового Bot API
+HANDLER_THREADS = int(os.getenv('HANDLER_THREADS', '4'))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '4'))
+SEND_QUEUE_SIZE = int(os.getenv('SEND_QUEUE_SIZE', '10000'))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+RUN_MODE = os.getenv('RUN_MODE', 'polling')  # polling | webhook
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публічна адреса для setWebhook; без неї вебхук не реєструється
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', '2'))
+COMPACT_BYTES = int(os.getenv('COMPACT_BYTES', str(1 << 20)))
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', '3600'))  # недозаповнені діалоги, секунди
+EXCHANGE_TTL = int(os.getenv('EXCHANGE_TTL', '86400'))  # скільки колега може відповідати на запит обміну
+CONVERSATION_MAX = int(os.getenv('CONVERSATION_MAX', '10000'))
+CONVERSATIONS_FILE = os.getenv('CONVERSATIONS_FILE')  # необов'язково: зберегти діалоги між перезапусками
+TEAMS_DIR = os.getenv('TEAMS_DIR', 'teams')  # шарди команд (групових чатів), крім 'default'
+CLUSTER_WORKER = os.getenv('CLUSTER_WORKER')  # номер воркера, якщо запущено через cluster.py
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', '1'))
+CLUSTER_DB = os.getenv('CLUSTER_DB', 'cluster.db')  # оренда лідера і позначки розісланих нагадувань
+CONVERSATIONS_DB = os.getenv('CONVERSATIONS_DB', 'conversations.db' if CLUSTER_WORKER is not None else '')
+REMINDER_SYNC_INTERVAL = float(os.getenv('REMINDER_SYNC_INTERVAL', '10'))
+REMINDERS_FILE = 'reminders.json'  # збережений індекс нагадувань, у теці кожної команди
+REMINDER_STATE_FILE = os.getenv('REMINDER_STATE_FILE', 'reminders.state.json')  # остання розіслана хвилина
+REMINDER_GRACE = float(os.getenv('REMINDER_GRACE', '3600'))  # наздогнати пропущені за простій, секунди
+STARTUP_DEFER = float(os.getenv('STARTUP_DEFER', '5'))  # відкладений старт, якщо оновлень немає
+MARKET_MAX_CYCLE = int(os.getenv('MARKET_MAX_CYCLE', '3'))  # найдовший ланцюг обміну на біржі
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '2000'))  # готові тексти розкладу і клавіатури
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 - без /metrics
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '0'))  # 0 - без зведення в лог
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', '0'))  # 0 - профайлер повільних хендлерів вимкнено
+
+MENU_OPTIONS = [
+    'Зареєструватися', 'Генерація поточного місяця', 'Генерація наступного місяця',
+    'Перегляд поточного місяця', 'Перегляд наступного місяця',
+    'Відпустка', 'Змінити час нагадування', 'Помінятись', 'Біржа обмінів', 'Покинути графік', 'Скасувати'
+]
+
+
+def handler_label(task, obj):
+    # Мітка для метрик: текст команди меню або префікс колбеку, без довільного тексту користувача
+    if isinstance(obj, types.CallbackQuery):
+        m = re.match(r'[a-z]+_[a-z]+_?', obj.data or '')
+        return m.group() if m else 'callback'
+    if isinstance(obj, types.Message):
+        if obj.text in MENU_OPTIONS or obj.text == '/start':
+            return obj.text
+        if getattr(task, '__self__', None) is None:
+            return task.__name__  # next-step хендлер: process_name, process_vac_end...
+        return 'message'
+    return 'other'
+
+
+class DutyBot(TeleBot):
+    def _exec_task(self, task, *args, **kwargs):
+        label = handler_label(task, args[0] if args else None)
+
+        def run(*a, **kw):
+            started = time.perf_counter()
+            try:
+                with profiler.track(label) if profiler else nullcontext():
+                    return task(*a, **kw)
+            except Exception:
+                registry.inc('handler_errors_total', handler=label)
+                raise
+            finally:
+                registry.observe('handler_seconds', time.perf_counter() - started, handler=label)
+                request_warm_up()
+        super()._exec_task(run, *args, **kwargs)
+
+    # telebot видаляє повідомлення зі списку прямо під час enumerate і пропускає наступне за ним,
+    # тож коли в одній пачці оновлень кілька відповідей на next-step, частина з них губилась
+    def _notify_next_handlers(self, new_messages):
+        rest = []
+        for message in new_messages:
+            handlers = self.next_step_backend.get_handlers(message.chat.id)
+            if not handlers:
+                rest.append(message)
+            for handler in handlers or []:
+                self._exec_task(handler["callback"], message, *handler["args"], **handler["kwargs"])
+        new_messages[:] = rest
+
+
+# Initialize bot, storage and scheduler
+if API_URL:
+    apihelper.API_URL = API_URL
+bot = DutyBot(TOKEN, num_threads=HANDLER_THREADS)
+outbox = Outbox(bot, workers=SEND_WORKERS, maxsize=SEND_QUEUE_SIZE,
+                global_rate=SEND_GLOBAL_RATE / CLUSTER_WORKERS, chat_rate=SEND_CHAT_RATE)
+outbox.start()
+stores = TeamStores(STORAGE_BACKEND, TEAMS_DIR, (DATA_FILE, DB_FILE, JOURNAL_FILE),
+                    flush_interval=FLUSH_INTERVAL, compact_bytes=COMPACT_BYTES)
+directory = TeamDirectory(os.path.join(TEAMS_DIR, 'members.jsonl'))
+if CONVERSATIONS_DB:
+    conversations = SqliteConversationStore(CONVERSATIONS_DB, ttl=CONVERSATION_TTL, max_entries=CONVERSATION_MAX)
+else:
+    conversations = ConversationStore(ttl=CONVERSATION_TTL, max_entries=CONVERSATION_MAX, path=CONVERSATIONS_FILE)
+conversations.load()
+views = RenderCache(RENDER_CACHE_SIZE)
+scheduler = None  # запускається у warm_up(), після першої відповіді
+if CLUSTER_WORKER is not None:
+    from cluster import Lease
+    lease = Lease(CLUSTER_DB)
+else:
+    lease = None
+profiler = metrics.SlowCallProfiler(PROFILE_SLOW_MS / 1000) if PROFILE_SLOW_MS else None
+
+# team -> {(date, hour, minute): [uid]}, rebuilt per team by schedule_reminders(team)
+reminder_index = {}
+reminder_jobs = {}  # team -> {(hour, minute)} з cron-задачею
+reminder_versions = {}  # team -> версії сховища, з яких зібрано індекс
+reminder_probes = {}  # team -> stores.probe(), знятий до збирання індексу
+reminder_ticks = {}  # team -> 'YYYY-MM-DDTHH:MM' останньої розісланої хвилини
+reminders_lock = threading.Lock()
+rebuild_locks = {}  # team -> RLock: перебудова індексу й точкові переноси однієї команди - по черзі
+ticks_lock = threading.Lock()
+startup_lock = threading.Lock()
+warm_up_requested = threading.Event()
+warmed_up = threading.Event()
+markets = {}  # team -> OfferBook
+market_locks = {}  # team -> Lock: пропозиції й угоди однієї команди - по черзі
+markets_lock = threading.Lock()
+market_days = {}  # team -> дата, за яку вже прибрано пропозиції на минулі дні
+
+# --- Metrics ---
+def on_job_event(event):
+    from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MISSED
+    job = event.job_id.split('_')[0]
+    if event.code == EVENT_JOB_SUBMITTED:
+        lag = datetime.now(timezone.utc) - event.scheduled_run_times[-1]
+        registry.observe('scheduler_job_lag_seconds', lag.total_seconds(), job=job)
+    elif event.code == EVENT_JOB_MISSED:
+        registry.inc('scheduler_job_missed_total', job=job)
+    else:
+        registry.inc('scheduler_job_errors_total', job=job)
 
-# Initialize bot and scheduler
-bot = TeleBot(TOKEN)
-scheduler = BackgroundScheduler(timezone=pytz.timezone(TIMEZONE))
-scheduler.start()
-
-# Pending exchange requests
-exchange_requests = {}
-
-# --- Data Persistence ---
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        return {'users': {}, 'schedule_current': {}, 'schedule_next': {}}
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
 
-def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+registry.gauge('exchange_requests_pending', lambda: conversations.count('exchange'), 'Exchange requests awaiting an answer')
+registry.gauge('conversations', lambda: len(conversations), 'In-progress dialog entries')
+registry.gauge('outbound_queue_depth', lambda: outbox.pending(), 'Bot API requests waiting to be sent')
+registry.gauge('teams_open', lambda: len(stores.stores), 'Team shards loaded in this process')
+registry.gauge('render_cache_entries', lambda: len(views), 'Cached schedule texts and keyboards')
+registry.gauge('swap_offers_open', lambda: sum(len(book) for book in list(markets.values())),
+               'Open swap-market offers in loaded books')
+registry.gauge('scheduler_jobs', lambda: len(scheduler.get_jobs()) if scheduler else 0, 'Scheduled reminder jobs')
 
 # --- Constants ---
 MONTHS_UK = [None, 'Січень', 'Лютий', 'Березень', 'Квітень', 'Травень', 'Червень',
@@ -42,37 +191,66 @@ DAYS_UK = {
 # --- Helper Functions ---
 def build_main_menu():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    options = [
-        'Зареєструватися', 'Генерація поточного місяця', 'Генерація наступного місяця',
-        'Перегляд поточного місяця', 'Перегляд наступного місяця',
-        'Відпустка', 'Змінити час нагадування', 'Помінятись', 'Скасувати'
-    ]
-    kb.add(*[types.KeyboardButton(opt) for opt in options])
+    kb.add(*[types.KeyboardButton(opt) for opt in MENU_OPTIONS])
     return kb
 
 
-def generate_schedule(year, month, users):
+MAIN_MENU = build_main_menu().to_json()  # меню незмінне, серіалізується один раз
+
+
+def vacation_mask(vacations, first, days):
+    # Бітова маска днів місяця (біт d-1 = день d), у які людина у відпустці
+    mask = 0
+    last = first + timedelta(days=days - 1)
+    for vac in vacations:
+        start = max(date.fromisoformat(vac['from'][:10]), first)
+        end = min(date.fromisoformat(vac['to'][:10]), last)
+        if start <= end:
+            mask |= ((1 << ((end - start).days + 1)) - 1) << (start - first).days
+    return mask
+
+
+@registry.timed('generate_schedule_seconds')
+def generate_schedule(year, month, users, prior=None):
+    # Чергування отримує найменш завантажений доступний колега (чергувань на доступний день,
+    # щоб відпустка не накопичувала борг); при рівності -
+    # той, у кого менше чергувань і давніше останнє чергування в попередньому розкладі (prior)
     _, days = calendar.monthrange(year, month)
-    dates = [datetime(year, month, d) for d in range(1, days + 1)]
-    availability = {}
-    for uid, info in users.items():
-        excluded = set()
-        for vac in info.get('vacation', []):
-            start = datetime.fromisoformat(vac['from']).date()
-            end = datetime.fromisoformat(vac['to']).date()
-            for dt in dates:
-                if start <= dt.date() <= end:
-                    excluded.add(dt)
-        availability[uid] = [dt for dt in dates if dt not in excluded]
+    first = date(year, month, 1)
+    masks = {uid: vacation_mask(info.get('vacation', []), first, days) for uid, info in users.items()}
+    prior_count, prior_last = {}, {}
+    for iso, uid in (prior or {}).items():
+        prior_count[uid] = prior_count.get(uid, 0) + 1
+        prior_last[uid] = max(prior_last.get(uid, 0), date.fromisoformat(iso).toordinal())
+    share = {uid: 1 / max(days - bin(mask).count('1'), 1) for uid, mask in masks.items()}
+    heap = [(0, 0, prior_count.get(uid, 0), prior_last.get(uid, 0), order, uid)
+            for order, uid in enumerate(users)]
+    heapq.heapify(heap)
     sched = {}
-    uids = list(users.keys())
-    idx = 0
-    for dt in dates:
-        for _ in uids:
-            uid = uids[idx % len(uids)]; idx += 1
-            if dt in availability.get(uid, []):
-                sched[dt.date().isoformat()] = uid
+    prev = None
+    for day in range(days):
+        # Той, хто чергував учора, береться лише якщо більше нікого немає
+        skipped, entry, held = [], None, None
+        while heap:
+            candidate = heapq.heappop(heap)
+            if masks[candidate[-1]] >> day & 1:
+                skipped.append(candidate)
+            elif candidate[-1] == prev and held is None:
+                held = candidate
+            else:
+                entry = candidate
                 break
+        if entry is None:
+            entry, held = held, None
+        if entry is not None:
+            _, load, count, _, order, uid = entry
+            dt = first + timedelta(days=day)
+            sched[dt.isoformat()] = prev = uid
+            heapq.heappush(heap, ((load + 1) * share[uid], load + 1, count, dt.toordinal(), order, uid))
+        else:
+            prev = None
+        for candidate in skipped + ([held] if held else []):
+            heapq.heappush(heap, candidate)
     return sched
 
 
@@ -87,256 +265,793 @@ def format_schedule(schedule, users, year, month):
     return "\n".join(lines)
 
 
-def schedule_reminders():
-    data = load_data()
-    sched = data.get('schedule_current', {})
-    for job in scheduler.get_jobs():
-        if job.id.startswith('reminder_'):
-            scheduler.remove_job(job.id)
-    for iso, uid in sched.items():
-        rt = data['users'][uid].get('reminder_time', DEFAULT_REMINDER_TIME)
-        def job(u=uid, d_iso=iso):
-            tz = pytz.timezone(TIMEZONE)
-            tomorrow = datetime.now(tz).date() + timedelta(days=1)
-            if d_iso == tomorrow.isoformat():
-                bot.send_message(int(u), f"Нагадування: завтра ({tomorrow.strftime('%d.%m')}) у вас чергування")
-        scheduler.add_job(job, 'cron', hour=rt['hour'], minute=rt['minute'], id=f"reminder_{iso}")
+# --- Cached Views ---
+# Перегляд розкладу і клавіатури обміну береться з views; перебудова лише тоді, коли
+# змінилися версії розкладу (генерація, обмін, передача днів) чи профілів користувачів
+def schedule_text(team, key, year, month):
+    store = stores.get(team)
+    def build():
+        sched = store.schedule(key)
+        return format_schedule(sched, store.users(), year, month) if sched else 'Розклад порожній.'
+    return views.get(('text', team, key, year, month), store.versions(key, 'users'), build)
+
+
+def dates_keyboard(team, key, uid, prefix, after=''):
+    # JSON клавіатури з датами чергувань uid (лише пізніше after), або None, якщо чергувань немає
+    store = stores.get(team)
+    def build():
+        dates = [d for d in store.user_dates(key, uid) if d > after]
+        if not dates:
+            return None
+        kb = types.InlineKeyboardMarkup()
+        for d in dates:
+            kb.add(types.InlineKeyboardButton(f'{d[8:10]}.{d[5:7]}', callback_data=f'{prefix}{d}'))
+        return kb.to_json()
+    return views.get(('dates', team, key, uid, prefix, after), store.versions(key), build)
+
+
+def colleagues_keyboard(team, key, uid):
+    store = stores.get(team)
+    def build():
+        kb = types.InlineKeyboardMarkup()
+        for other_uid in sorted(store.duty_uids(key) - {uid}):
+            user_info = store.get_user(other_uid) or {}
+            name = f"{user_info.get('emoji', '')} {user_info.get('name', f'UID {other_uid}')}"
+            kb.add(types.InlineKeyboardButton(name, callback_data=f'ex_user_{other_uid}'))
+        return kb.to_json()
+    return views.get(('colleagues', team, key, uid), store.versions(key, 'users'), build)
+
+
+# --- Reminders ---
+# У кожної команди свій індекс і свої cron-задачі (одна на кожен різний час нагадування),
+# тож команди перебудовуються й розсилаються незалежно, паралельно в пулі планувальника
+def build_reminder_index(team):
+    # (дата чергування, година, хвилина) -> [uid]; наступний місяць теж, щоб нагадати про 1-ше число
+    store = stores.get(team)
+    users = store.users()
+    index = {}
+    for key in ('schedule_current', 'schedule_next'):
+        for iso, uid in store.schedule(key).items():
+            h, m = reminder_time(users.get(uid))
+            index.setdefault((iso, h, m), []).append(uid)
+    return index
+
+
+def send_reminders(team, day, hour, minute):
+    tick = f'{day - timedelta(days=1)}T{hour:02d}:{minute:02d}'
+    if tick <= reminder_ticks.get(team, ''):
+        return  # уже розіслано (напр. наздогнали при старті в ту ж хвилину)
+    if lease is not None and not lease.claim(f'reminder:{team}:{day.isoformat()}:{hour:02d}{minute:02d}'):
+        return  # цю хвилину вже розіслав інший процес
+    for uid in list(reminder_index.get(team, {}).get((day.isoformat(), hour, minute), [])):
+        outbox.send(int(uid), f"Нагадування: завтра ({day.strftime('%d.%m')}) у вас чергування", bulk=True)
+    mark_tick(team, tick)
+
+
+def dispatch_reminders(team, hour, minute):
+    tomorrow = datetime.now(pytz.timezone(TIMEZONE)).date() + timedelta(days=1)
+    send_reminders(team, tomorrow, hour, minute)
+
+
+def mark_tick(team, tick):
+    with ticks_lock:
+        if tick <= reminder_ticks.get(team, ''):
+            return
+        reminder_ticks[team] = tick
+        atomic_write(REMINDER_STATE_FILE, json.dumps(reminder_ticks).encode('utf-8'))
+
+
+def catch_up_reminders():
+    # Нагадування, чий час минув, поки бот не працював: не давніше REMINDER_GRACE
+    # і лише після останньої розісланої хвилини, тож повторів не буде
+    tz = pytz.timezone(TIMEZONE)
+    now = datetime.now(tz).replace(second=0, microsecond=0)
+    floor = (now - timedelta(seconds=REMINDER_GRACE)).strftime('%Y-%m-%dT%H:%M')
+    current = now.strftime('%Y-%m-%dT%H:%M')
+    with reminders_lock:
+        slots = [(team, iso, h, m) for team, index in reminder_index.items() for iso, h, m in index]
+    due = []
+    for team, iso, h, m in slots:
+        tick = f'{date.fromisoformat(iso) - timedelta(days=1)}T{h:02d}:{m:02d}'
+        last = reminder_ticks.get(team)
+        if last and last < tick and floor <= tick <= current:
+            due.append((tick, team, iso, h, m))
+    for _, team, iso, h, m in sorted(due):
+        registry.inc('reminders_caught_up_total')
+        send_reminders(team, date.fromisoformat(iso), h, m)
+
+
+def rebuild_lock(team):
+    with reminders_lock:
+        return rebuild_locks.setdefault(team, threading.RLock())
+
+
+@registry.timed('schedule_reminders_seconds')
+def schedule_reminders(team):
+    # Читання і встановлення - під замком команди: інакше паралельна перебудова чи move_reminders
+    # могли б закінчитися раніше, і старіший знімок розкладу лишився б останнім
+    with rebuild_lock(team):
+        probe = stores.probe(team)  # до версій: зміна між ними лише змусить перевірити шард ще раз
+        versions = stores.get(team).versions('schedule_current', 'schedule_next', 'users')
+        index = build_reminder_index(team)
+        wanted = {(h, m) for _, h, m in index}
+        with reminders_lock:
+            reminder_index[team] = index
+            reminder_versions[team] = versions
+            reminder_probes[team] = probe
+            for h, m in reminder_jobs.get(team, set()) - wanted:
+                if scheduler is not None:
+                    scheduler.remove_job(reminder_job_id(team, h, m))
+                reminder_jobs[team].discard((h, m))
+            for h, m in wanted:
+                ensure_reminder_job(team, h, m)
+        save_reminders(team)
+
+
+def save_reminders(team):
+    # Компактна копія індексу: після перезапуску задачі відновлюються з неї без читання розкладів
+    with reminders_lock:
+        payload = {'versions': reminder_versions.get(team), 'probe': reminder_probes.get(team),
+                   'index': [[iso, h, m, uids] for (iso, h, m), uids in reminder_index.get(team, {}).items() if uids]}
+    atomic_write(stores.file(team, REMINDERS_FILE), json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+
+
+def restore_reminders():
+    for team in stores.known():
+        try:
+            with open(stores.file(team, REMINDERS_FILE), 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            continue  # немає копії - sync_reminders() збере індекс зі сховища
+        index = {(iso, h, m): uids for iso, h, m, uids in saved['index']}
+        with reminders_lock:
+            if team in reminder_index:
+                continue  # уже перебудовано хендлером
+            reminder_index[team] = index
+            reminder_versions[team] = tuple(saved['versions'] or ())
+            reminder_probes[team] = saved.get('probe')
+            for _, h, m in index:
+                ensure_reminder_job(team, h, m)
+
+
+def sync_reminders():
+    # Зміни могли прийти через інші процеси (або поки бот не працював):
+    # перебудувати команди, чиї версії зрушили. Ще не відкритий шард, чий відбиток збігається
+    # зі збереженим разом з індексом, не відкривається - старт не залежить від кількості команд
+    for team in stores.known():
+        loaded = team in stores.stores
+        probe = None if loaded else stores.probe(team)
+        if probe is not None and reminder_probes.get(team) == probe:
+            continue
+        versions = stores.get(team).versions('schedule_current', 'schedule_next', 'users')
+        if reminder_versions.get(team) != versions:
+            schedule_reminders(team)
+        elif not loaded:
+            with reminders_lock:
+                reminder_probes[team] = probe  # індекс актуальний: наступного разу не відкривати
+            save_reminders(team)
+
+
+# --- Startup ---
+def start_scheduler():
+    global scheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MISSED, EVENT_JOB_ERROR
+    sched = BackgroundScheduler(timezone=pytz.timezone(TIMEZONE))
+    sched.add_listener(on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED | EVENT_JOB_ERROR)
+    if CLUSTER_WORKER is not None:
+        sched.add_job(sync_reminders, 'interval', seconds=REMINDER_SYNC_INTERVAL, id='sync_reminders')
+    with reminders_lock:
+        for team, times in reminder_jobs.items():
+            for h, m in times:
+                add_reminder_job(sched, team, h, m)
+        # У кластері задачі додаються в кожному воркері, але виконуються лише в лідера
+        sched.start(paused=CLUSTER_WORKER is not None)
+        scheduler = sched
+
+
+def warm_up():
+    # Відкладений старт: APScheduler, збережені індекси нагадувань і пропущені за простій
+    # нагадування - уже після першої відповіді, щоб холодний старт її не затримував
+    with startup_lock:
+        if warmed_up.is_set():
+            return
+        with registry.timer('warm_up_seconds'):
+            if os.path.exists(REMINDER_STATE_FILE):
+                with open(REMINDER_STATE_FILE, 'r', encoding='utf-8') as f:
+                    reminder_ticks.update(json.load(f))
+            start_scheduler()
+            restore_reminders()
+            if lease is None:
+                catch_up_reminders()
+            sync_reminders()
+        warmed_up.set()
+
+
+def request_warm_up():
+    if not warm_up_requested.is_set():
+        warm_up_requested.set()
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+
+def become_leader():
+    warm_up()
+    sync_reminders()
+    catch_up_reminders()
+    scheduler.resume()
+
+
+def step_down():
+    if scheduler is not None:
+        scheduler.pause()
+
+
+def reminder_job_id(team, h, m):
+    return f"reminder_{team}_{h:02d}{m:02d}"
+
+
+def add_reminder_job(sched, team, h, m):
+    sched.add_job(dispatch_reminders, 'cron', hour=h, minute=m, args=(team, h, m),
+                  id=reminder_job_id(team, h, m), replace_existing=True)
+
+
+def ensure_reminder_job(team, h, m):
+    # До старту планувальника лише запам'ятовує; start_scheduler() додасть усі разом
+    jobs = reminder_jobs.setdefault(team, set())
+    if (h, m) not in jobs:
+        if scheduler is not None:
+            add_reminder_job(scheduler, team, h, m)
+        jobs.add((h, m))
+
+
+def reminder_time(info):
+    rt = (info or {}).get('reminder_time', DEFAULT_REMINDER_TIME)
+    return rt['hour'], rt['minute']
+
+
+def move_reminders(team, changes, old_uid, old_info, users):
+    # Переносить у індексі лише записи змінених днів; задачі для нових часів додаються за потреби
+    # Ідемпотентно: перебудова, що вже бачила ці зміни, не отримає дублікатів
+    oh, om = reminder_time(old_info)
+    with rebuild_lock(team):
+        with reminders_lock:
+            index = reminder_index.setdefault(team, {})
+            for iso, uid in changes.items():
+                entry = index.get((iso, oh, om))
+                if entry and old_uid in entry:
+                    entry.remove(old_uid)
+                h, m = reminder_time(users.get(uid))
+                entry = index.setdefault((iso, h, m), [])
+                if uid not in entry:
+                    entry.append(uid)
+                ensure_reminder_job(team, h, m)
+        save_reminders(team)
+
+# --- Schedule Repair ---
+def on_vacation(info, iso):
+    return any(vac['from'][:10] <= iso <= vac['to'][:10] for vac in info.get('vacation', []))
+
+
+def pick_replacement(users, counts, iso, neighbours):
+    # Найменш завантажений доступний колега; сусіди по днях (учора/завтра) - лише якщо більше нікого
+    candidates = [(uid in neighbours, counts.get(uid, 0), order, uid)
+                  for order, (uid, info) in enumerate(users.items()) if not on_vacation(info, iso)]
+    return min(candidates)[-1] if candidates else None
+
+
+def repair_schedule(team, uid, start=None, end=None, attempts=5):
+    # Передає колегам лише дні uid у проміжку [start, end] (від сьогодні), решта розкладу
+    # разом з обмінами не змінюється. Повертає ({колега: [дати]}, [дати без заміни])
+    today = datetime.now(pytz.timezone(TIMEZONE)).date().isoformat()
+    start = max(start or today, today)
+    store = stores.get(team)
+    users = store.users()
+    old_info = users.pop(uid, None)
+    given, kept = {}, []
+    for key in ('schedule_current', 'schedule_next'):
+        for _ in range(attempts):
+            dates = [iso for iso in store.user_dates(key, uid) if start <= iso and (end is None or iso <= end)]
+            counts = store.duty_counts(key)
+            changes, missing = {}, []
+            for iso in dates:
+                day = date.fromisoformat(iso)
+                neighbours = {changes.get(d) or store.on_duty(key, d)
+                              for d in ((day - timedelta(days=1)).isoformat(), (day + timedelta(days=1)).isoformat())}
+                new = pick_replacement(users, counts, iso, neighbours)
+                if new is None:
+                    missing.append(iso)
+                    continue
+                changes[iso] = new
+                counts[new] = counts.get(new, 0) + 1
+            try:
+                # Передача і перенос нагадувань разом: перебудова між ними встановила б новіший
+                # індекс, а запізнілий перенос зіпсував би його
+                with rebuild_lock(team):
+                    if changes:
+                        store.reassign(key, changes, uid)
+                    move_reminders(team, changes, uid, old_info, users)
+                break
+            except Conflict:
+                continue  # паралельний обмін змінив розклад; перерахувати з новими даними
+        else:
+            raise Conflict(key)
+        kept += missing
+        for iso, new in changes.items():
+            given.setdefault(new, []).append(iso)
+    return given, kept
+
+
+def notify_repair(uid, given, kept, reason):
+    fmt = lambda dates: ', '.join(date.fromisoformat(iso).strftime('%d.%m') for iso in sorted(dates))
+    moved = sorted(iso for dates in given.values() for iso in dates)
+    if moved or kept:
+        text = f"{reason}: ваші чергування {fmt(moved)} передано колегам." if moved else reason + '.'
+        if kept:
+            text += f"\nНе знайшлося заміни на {fmt(kept)}."
+        outbox.send(int(uid), text, bulk=True)
+    for other, dates in given.items():
+        outbox.send(int(other), f"Вам додано чергування: {fmt(dates)}", bulk=True)
+
+def store_of(uid):
+    return stores.get(directory.team_of(uid))
+
+# --- Swap Market ---
+def market_lock(team):
+    with markets_lock:
+        return market_locks.setdefault(team, threading.Lock())
+
+
+def offer_book(team):
+    # Викликати під market_lock(team). Книга перебудовується, лише якщо пропозиції змінив
+    # хтось інший (інший процес кластера, перегенерація розкладу, обмін, вихід з графіка)
+    store = stores.get(team)
+    today = datetime.now(pytz.timezone(TIMEZONE)).date().isoformat()
+    if market_days.get(team) != today:
+        store.expire_offers(today)  # раз на день: дати, що настали, вже не обміняти
+        market_days[team] = today
+    version = store.versions('offers')
+    book = markets.get(team)
+    if book is None or book.version != version:
+        with registry.timer('market_rebuild_seconds'):
+            book = markets[team] = OfferBook((offer_from_dict(oid, o) for oid, o in store.offers().items()), version)
+    return book
+
+
+def market_update(team, book, before, change):
+    # Власна зміна цього процесу: підправити книгу на місці, якщо між нами ніхто не писав
+    after = stores.get(team).versions('offers')
+    if book.version == before and after == (before[0] + 1,):
+        change(book)
+        book.version = after
+
+
+def trade_validator(team):
+    # Дата ще за тим, хто її віддає, не сьогодні й не в минулому, а той, хто бере, не у відпустці
+    store = stores.get(team)
+    holders = {key: store.schedule(key) for key in ('schedule_current', 'schedule_next')}
+    today = datetime.now(pytz.timezone(TIMEZONE)).date().isoformat()
+    users = {}
+
+    def valid(taker, giver):
+        if giver.give <= today or holders[giver.key].get(giver.give) != giver.uid:
+            return False
+        if holders[taker.key].get(taker.give) != taker.uid:
+            return False
+        if taker.uid not in users:
+            users[taker.uid] = store.get_user(taker.uid) or {}
+        return not on_vacation(users[taker.uid], giver.give)
+    return valid
+
+
+def settle(team, oid, attempts=3):
+    # Шукає цикл через пропозицію oid і застосовує його однією транзакцією сховища
+    for _ in range(attempts):
+        book = offer_book(team)
+        with registry.timer('market_match_seconds'):
+            cycle = book.find_cycle(oid, trade_validator(team), MARKET_MAX_CYCLE)
+        if cycle is None:
+            return None
+        try:
+            stores.get(team).trade(moves(cycle), [o.oid for o in cycle])
+        except Conflict:
+            registry.inc('market_conflicts_total')
+            markets.pop(team, None)
+            continue
+        registry.inc('market_trades_total', size=len(cycle))
+        markets.pop(team, None)  # угода прибрала й застарілі пропозиції на ці дати
+        return cycle
+    return None
+
+
+def post_offer(team, uid, key, give, take):
+    # -> (oid, виконаний цикл або None); Conflict, якщо дата вже не за uid, ValueError - якщо вона настала
+    store = stores.get(team)
+    if give <= datetime.now(pytz.timezone(TIMEZONE)).date().isoformat():
+        raise ValueError(f'{give} is not in the future')
+    with market_lock(team):
+        book = offer_book(team)
+        before = book.version
+        oid = store.post_offer(uid, key, give, take)
+        offer = Offer(oid, uid, key, give, None if take is None else frozenset(take), time.time())
+        market_update(team, book, before, lambda b: b.add(offer))
+        cycle = settle(team, oid)
+    if cycle:
+        schedule_reminders(team)
+        notify_trade(cycle)
+    return oid, cycle
+
+
+def withdraw_offer(team, uid, oid):
+    with market_lock(team):
+        book = offer_book(team)
+        before = book.version
+        if not stores.get(team).withdraw_offer(oid, uid):
+            return False
+        market_update(team, book, before, lambda b: b.remove(oid))
+        return True
+
+
+def notify_trade(cycle):
+    fmt = lambda iso: f'{iso[8:]}.{iso[5:7]}'
+    gave = {giver: iso for _, iso, giver, _ in moves(cycle)}
+    took = {taker: iso for _, iso, _, taker in moves(cycle)}
+    party = 'удвох' if len(cycle) == 2 else f'ланцюгом з {len(cycle)} людей'
+    for uid in gave:
+        outbox.send(int(uid), f"🔁 Біржа: обмін {party} виконано. Ви віддали {fmt(gave[uid])}, "
+                              f"ваше нове чергування: {fmt(took[uid])}.", bulk=True)
+
+# --- Months ---
+def month_of(key, now=None):
+    now = now or datetime.now(pytz.timezone(TIMEZONE))
+    if key == 'schedule_next':
+        now += timedelta(days=31)
+    return now.year, now.month
+
+
+def month_key(arg):
+    # 'current' | 'next' | 'YYYY-MM' -> 'YYYY-MM'
+    if arg in (None, '', 'current', 'next'):
+        return '%04d-%02d' % month_of('schedule_next' if arg == 'next' else 'schedule_current')
+    return datetime.strptime(arg, '%Y-%m').strftime('%Y-%m')
+
+
+def regenerate(team, keys=('schedule_current', 'schedule_next')):
+    store = stores.get(team)
+    for key in keys:
+        prior = store.schedule('schedule_current') if key == 'schedule_next' else None
+        store.set_schedule(key, generate_schedule(*month_of(key), store.users(), prior=prior))
+    schedule_reminders(team)
+
+# --- Bulk Import ---
+@registry.timed('import_seconds')
+def import_roster(team, rows, generate=True):
+    # Потік рядків bulk.parse_rows -> одна транзакція сховища -> одна перегенерація розкладу.
+    # Людей з інших команд не переносимо мовчки - як і /join, імпорт тоді відмовляє
+    joined = set()
+
+    def checked():
+        for uid, fields, vac in rows:
+            owner = directory.team_of(uid)
+            if owner != team and uid not in joined:
+                if stores.get(owner).get_user(uid) is not None:
+                    raise ValueError(f'user {uid} is already in team {owner}')
+                joined.add(uid)
+            yield uid, fields, vac
+
+    users, vacations = stores.get(team).import_rows(checked(), IMPORT_DEFAULTS)
+    directory.join_many(joined, team)
+    if generate:
+        regenerate(team)
+    else:
+        schedule_reminders(team)  # могли змінитися часи нагадувань
+    return users, vacations
+
+
+def is_admin(msg):
+    return str(msg.from_user.id) in ADMIN_IDS
 
 # --- Bot Handlers ---
+@bot.message_handler(commands=['join'], chat_types=['group', 'supergroup'])
+def cmd_join(msg):
+    # Груповий чат = команда; /join у групі переносить автора в її графік
+    uid, team = str(msg.from_user.id), str(msg.chat.id)
+    if directory.team_of(uid) != team and store_of(uid).get_user(uid) is not None:
+        outbox.send(msg.chat.id, "Ви вже в графіку іншої команди. Спочатку «Покинути графік» в особистих повідомленнях.")
+        return
+    directory.join(uid, team)
+    stores.get(team)
+    outbox.send(msg.chat.id, f"{msg.from_user.first_name} тепер у команді «{msg.chat.title}». "
+                             "Напишіть боту в особисті, щоб зареєструватися.")
+
+@bot.message_handler(content_types=['document'], chat_types=['private'],
+                     func=lambda m: is_admin(m) and (m.caption or '').startswith('/import'))
+def cmd_import_file(msg):
+    team, doc = directory.team_of(msg.from_user.id), msg.document
+    name = doc.file_name or 'import.csv'
+    data = bot.download_file(bot.get_file(doc.file_id).file_path)
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline='')
+    try:
+        users, vacations = import_roster(team, bulk.parse_rows(stream, bulk.detect_format(name), name))
+    except ValueError as e:
+        outbox.send(msg.chat.id, f"Імпорт скасовано, нічого не змінено: {e}")
+        return
+    outbox.send(msg.chat.id, f"Імпортовано людей: {users}, відпусток: {vacations}. Розклад перегенеровано.",
+                reply_markup=MAIN_MENU)
+
+@bot.message_handler(commands=['import'], chat_types=['private'], func=is_admin)
+def cmd_import(msg):
+    outbox.send(msg.chat.id, "Надішліть CSV або JSONL файлом з підписом /import.\n"
+                             "Колонки: uid, name, emoji, reminder (ГГ:ХХ) - профіль; uid, from, to - відпустка.")
+
+@bot.message_handler(commands=['export'], chat_types=['private'], func=is_admin)
+def cmd_export(msg):
+    # /export [current|next|YYYY-MM]; місяць команди - не більше 31 рядка, тож файл збирається зі шматків у пам'яті
+    arg = (msg.text.split(maxsplit=1)[1:] or [''])[0].strip()
+    try:
+        month = month_key(arg)
+    except ValueError:
+        outbox.send(msg.chat.id, "Формат: /export current | next | YYYY-MM")
+        return
+    team = directory.team_of(msg.from_user.id)
+    payload = ''.join(bulk.export_month(stores.get(team), month)).encode('utf-8')
+    outbox.submit(msg.chat.id, 'send_document', msg.chat.id, payload, visible_file_name=f'schedule-{month}.csv')
+
+@bot.message_handler(commands=['calendar'], chat_types=['private'])
+def cmd_calendar(msg):
+    uid = str(msg.chat.id); store = store_of(uid)
+    if store.get_user(uid) is None:
+        outbox.send(msg.chat.id, "Спочатку зареєструйтесь.", reply_markup=MAIN_MENU)
+        return
+    payload = ''.join(bulk.ical_feed(store, uid)).encode('utf-8')
+    outbox.submit(msg.chat.id, 'send_document', msg.chat.id, payload, visible_file_name='duties.ics',
+                  caption="Ваші чергування: імпортуйте файл у календар.")
+
 @bot.message_handler(commands=['start'])
 def cmd_start(msg):
-    bot.send_message(msg.chat.id, "Привіт! Я бот для чергувань. Оберіть опцію меню.", reply_markup=build_main_menu())
+    outbox.send(msg.chat.id, "Привіт! Я бот для чергувань. Оберіть опцію меню.", reply_markup=MAIN_MENU)
 
-@bot.message_handler(func=lambda m: m.text == 'Скасувати')
+@bot.message_handler(func=lambda m: m.text == 'Скасувати', chat_types=['private'])
 def cmd_cancel(msg):
     try:
         bot.clear_step_handler_by_chat_id(msg.chat.id)
     except:
         pass
-    data = load_data()
     uid = str(msg.chat.id)
-    data['users'].get(uid, {}).pop('vac_temp', None)
-    data['users'].get(uid, {}).pop('ex_temp', None)
-    save_data(data)
-    bot.send_message(msg.chat.id, "Команду скасовано.", reply_markup=build_main_menu())
+    conversations.clear(uid, 'vac_temp', 'ex_temp', 'mk_temp')
+    outbox.send(msg.chat.id, "Команду скасовано.", reply_markup=MAIN_MENU)
 
-@bot.message_handler(func=lambda m: m.text == 'Зареєструватися')
+@bot.message_handler(func=lambda m: m.text == 'Зареєструватися', chat_types=['private'])
 def cmd_register(msg):
-    sent = bot.send_message(msg.chat.id, "Введіть ваше ім'я:")
-    bot.register_next_step_handler(sent, process_name)
+    bot.register_next_step_handler_by_chat_id(msg.chat.id, process_name)
+    outbox.send(msg.chat.id, "Введіть ваше ім'я:")
 
 def process_name(msg):
     if msg.text == 'Скасувати': return cmd_cancel(msg)
-    data = load_data(); uid = str(msg.chat.id)
-    data['users'].setdefault(uid, {})['name'] = msg.text.strip()
-    save_data(data)
-    sent = bot.send_message(msg.chat.id, "Введіть емоджі для чергування:")
-    bot.register_next_step_handler(sent, process_emoji)
+    uid = str(msg.chat.id)
+    store_of(uid).update_user(uid, name=msg.text.strip())
+    bot.register_next_step_handler_by_chat_id(msg.chat.id, process_emoji)
+    outbox.send(msg.chat.id, "Введіть емоджі для чергування:")
 
 def process_emoji(msg):
     if msg.text == 'Скасувати': return cmd_cancel(msg)
-    data = load_data(); uid = str(msg.chat.id)
-    data['users'][uid]['emoji'] = msg.text.strip()
-    data['users'][uid]['reminder_time'] = DEFAULT_REMINDER_TIME
-    data['users'][uid].setdefault('vacation', [])
-    save_data(data)
-    bot.send_message(msg.chat.id, "Реєстрація завершена!", reply_markup=build_main_menu())
+    uid = str(msg.chat.id)
+    store_of(uid).register_user(uid, msg.text.strip(), DEFAULT_REMINDER_TIME)
+    outbox.send(msg.chat.id, "Реєстрація завершена!", reply_markup=MAIN_MENU)
 
 @bot.message_handler(func=lambda m: m.text in [
     'Генерація поточного місяця','Генерація наступного місяця',
     'Перегляд поточного місяця','Перегляд наступного місяця'
 ])
 def cmd_schedule(msg):
-    data = load_data(); now = datetime.now(pytz.timezone(TIMEZONE)); cmd = msg.text
+    # Команда - за автором: у груповому чаті msg.chat.id - це id групи, а не учасника
+    cmd = msg.text; team = directory.team_of(msg.from_user.id)
+    key = 'schedule_current' if 'поточн' in cmd else 'schedule_next'
     if 'Генерація' in cmd:
-        if 'поточн' in cmd: year, month, key = now.year, now.month, 'schedule_current'
-        else: nxt = now + timedelta(days=31); year, month, key = nxt.year, nxt.month, 'schedule_next'
-        sched = generate_schedule(year, month, data['users'])
-        data[key] = sched; save_data(data); schedule_reminders()
-        bot.send_message(msg.chat.id, f"{cmd} виконано.", reply_markup=build_main_menu())
+        regenerate(team, (key,))
+        outbox.send(msg.chat.id, f"{cmd} виконано.", reply_markup=MAIN_MENU)
     else:
-        if 'поточн' in cmd:
-            sched = data.get('schedule_current', {}); year, month = now.year, now.month
-        else:
-            sched = data.get('schedule_next', {}); nxt = now + timedelta(days=31)
-            year, month = nxt.year, nxt.month
-        text = format_schedule(sched, data['users'], year, month) if sched else 'Розклад порожній.'
-        bot.send_message(msg.chat.id, text, reply_markup=build_main_menu())
+        outbox.send(msg.chat.id, schedule_text(team, key, *month_of(key)), reply_markup=MAIN_MENU)
 
-@bot.message_handler(func=lambda m: m.text == 'Відпустка')
+@bot.message_handler(func=lambda m: m.text == 'Відпустка', chat_types=['private'])
 def cmd_vacation(msg):
-    sent = bot.send_message(msg.chat.id, "Вкажіть початок відпустки (YYYY-MM-DD):")
-    bot.register_next_step_handler(sent, process_vac_start)
+    bot.register_next_step_handler_by_chat_id(msg.chat.id, process_vac_start)
+    outbox.send(msg.chat.id, "Вкажіть початок відпустки (YYYY-MM-DD):")
 
 def process_vac_start(msg):
     if msg.text == 'Скасувати': return cmd_cancel(msg)
     try:
         start = datetime.fromisoformat(msg.text.strip()).date()
-        data = load_data(); uid = str(msg.chat.id)
-        data['users'][uid]['vac_temp'] = {'from': start.isoformat()}
-        save_data(data)
-        sent = bot.send_message(msg.chat.id, "Вкажіть кінець відпустки (YYYY-MM-DD):")
-        bot.register_next_step_handler(sent, process_vac_end)
+        uid = str(msg.chat.id)
+        conversations.set(uid, 'vac_temp', {'from': start.isoformat()})
+        bot.register_next_step_handler_by_chat_id(msg.chat.id, process_vac_end)
+        outbox.send(msg.chat.id, "Вкажіть кінець відпустки (YYYY-MM-DD):")
     except ValueError:
-        sent = bot.send_message(msg.chat.id, "Невірний формат YYYY-MM-DD:")
-        bot.register_next_step_handler(sent, process_vac_start)
+        bot.register_next_step_handler_by_chat_id(msg.chat.id, process_vac_start)
+        outbox.send(msg.chat.id, "Невірний формат YYYY-MM-DD:")
 
 def process_vac_end(msg):
     if msg.text == 'Скасувати': return cmd_cancel(msg)
+    uid = str(msg.chat.id)
     try:
         end = datetime.fromisoformat(msg.text.strip()).date()
-        data = load_data(); uid = str(msg.chat.id)
-        vac = data['users'][uid].pop('vac_temp')
-        vac['to'] = end.isoformat()
-        data['users'][uid].setdefault('vacation', []).append(vac)
-        save_data(data)
-        bot.send_message(msg.chat.id, "Період відпустки збережено.", reply_markup=build_main_menu())
     except ValueError:
-        sent = bot.send_message(msg.chat.id, "Невірний формат YYYY-MM-DD:")
-        bot.register_next_step_handler(sent, process_vac_end)
+        bot.register_next_step_handler_by_chat_id(msg.chat.id, process_vac_end)
+        outbox.send(msg.chat.id, "Невірний формат YYYY-MM-DD:")
+        return
+    vac = conversations.get(uid, 'vac_temp')
+    if vac is None:
+        outbox.send(msg.chat.id, "Час на введення вийшов, почніть знову.", reply_markup=MAIN_MENU)
+        return
+    if end.isoformat() < vac['from']:
+        bot.register_next_step_handler_by_chat_id(msg.chat.id, process_vac_end)
+        outbox.send(msg.chat.id, f"Кінець відпустки раніше за початок ({vac['from']}). Вкажіть кінець (YYYY-MM-DD):")
+        return
+    conversations.clear(uid, 'vac_temp')
+    vac['to'] = end.isoformat()
+    team = directory.team_of(uid)
+    stores.get(team).add_vacation(uid, vac)
+    outbox.send(msg.chat.id, "Період відпустки збережено.", reply_markup=MAIN_MENU)
+    try:
+        given, kept = repair_schedule(team, uid, vac['from'], vac['to'])
+    except Conflict:
+        # Відпустку збережено, але розклад весь час змінювався паралельно - сказати, а не мовчати
+        outbox.send(msg.chat.id, "⚠️ Розклад саме змінювався, тож ваші чергування у відпустці колегам не передано. "
+                                 "Перегенеруйте розклад або попросіть когось помінятись.")
+        return
+    notify_repair(uid, given, kept, 'Відпустку враховано')
 
-@bot.message_handler(func=lambda m: m.text == 'Змінити час нагадування')
+@bot.message_handler(func=lambda m: m.text == 'Змінити час нагадування', chat_types=['private'])
 def cmd_change(msg):
-    sent = bot.send_message(msg.chat.id, "Введіть час нагадування ГГ:ХХ:")
-    bot.register_next_step_handler(sent, process_reminder_time)
+    bot.register_next_step_handler_by_chat_id(msg.chat.id, process_reminder_time)
+    outbox.send(msg.chat.id, "Введіть час нагадування ГГ:ХХ:")
 
 def process_reminder_time(msg):
     if msg.text == 'Скасувати': return cmd_cancel(msg)
     try:
         h, mi = map(int, msg.text.strip().split(':'))
         if not (0 <= h <= 23 and 0 <= mi <= 59): raise ValueError
-        data = load_data(); uid = str(msg.chat.id)
-        data['users'].setdefault(uid, {})['reminder_time'] = {'hour': h, 'minute': mi}
-        save_data(data); schedule_reminders()
-        bot.send_message(msg.chat.id, f"Нагадування: {h:02d}:{mi:02d}", reply_markup=build_main_menu())
+        uid = str(msg.chat.id)
+        team = directory.team_of(uid)
+        stores.get(team).update_user(uid, reminder_time={'hour': h, 'minute': mi})
+        schedule_reminders(team)
+        outbox.send(msg.chat.id, f"Нагадування: {h:02d}:{mi:02d}", reply_markup=MAIN_MENU)
     except Exception:
-        sent = bot.send_message(msg.chat.id, "Невірний формат ГГ:ХХ:")
-        bot.register_next_step_handler(sent, process_reminder_time)
+        bot.register_next_step_handler_by_chat_id(msg.chat.id, process_reminder_time)
+        outbox.send(msg.chat.id, "Невірний формат ГГ:ХХ:")
+
+@bot.message_handler(func=lambda m: m.text == 'Покинути графік', chat_types=['private'])
+def cmd_leave(msg):
+    uid = str(msg.from_user.id)
+    if store_of(uid).get_user(uid) is None:
+        outbox.send(msg.chat.id, "Ви не зареєстровані.", reply_markup=MAIN_MENU)
+        return
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton('Так, покинути', callback_data='leave_yes'),
+           types.InlineKeyboardButton('Ні', callback_data='leave_no'))
+    outbox.send(msg.chat.id, "Ваші майбутні чергування буде передано колегам. Покинути графік?", reply_markup=kb)
 
-@bot.message_handler(func=lambda m: m.text == 'Помінятись')
+@bot.callback_query_handler(func=lambda c: c.data in ('leave_yes', 'leave_no'))
+def handle_leave(c):
+    uid = str(c.from_user.id)
+    outbox.submit(c.from_user.id, 'answer_callback_query', c.id)
+    team = directory.team_of(uid); store = stores.get(team)
+    if c.data == 'leave_no' or store.get_user(uid) is None:
+        outbox.submit(uid, 'edit_message_text', "Скасовано.", c.message.chat.id, c.message.message_id)
+        return
+    try:
+        given, kept = repair_schedule(team, uid)
+    except Conflict:
+        # Чергування ще не передано - не видаляти, інакше в розкладі лишаться дні без людини
+        outbox.submit(uid, 'edit_message_text', "⚠️ Розклад саме змінювався, тож вийти з графіка не вдалося. "
+                                                "Спробуйте ще раз за хвилину.", c.message.chat.id, c.message.message_id)
+        return
+    store.remove_user(uid)
+    conversations.clear(uid, 'vac_temp', 'ex_temp', 'mk_temp')
+    outbox.submit(uid, 'edit_message_text', "Ви покинули графік.", c.message.chat.id, c.message.message_id)
+    notify_repair(uid, given, kept, 'Ви покинули графік')
+
+@bot.message_handler(func=lambda m: m.text == 'Помінятись', chat_types=['private'])
 def cmd_ex(msg):
     uid = str(msg.chat.id)
-    data = load_data()
-    data['users'].setdefault(uid, {})['ex_temp'] = {}  # скидання попередніх даних
-    save_data(data)
+    conversations.set(uid, 'ex_temp', {})  # скидання попередніх даних
 
     kb = types.InlineKeyboardMarkup()
     kb.add(
         types.InlineKeyboardButton("📅 Поточний місяць", callback_data='ex_month_current'),
         types.InlineKeyboardButton("📅 Наступний місяць", callback_data='ex_month_next')
     )
-    bot.send_message(msg.chat.id, "Оберіть місяць для обміну чергуванням:", reply_markup=kb)
+    outbox.send(msg.chat.id, "Оберіть місяць для обміну чергуванням:", reply_markup=kb)
+
+def exchange_expired(c):
+    outbox.submit(c.from_user.id, 'answer_callback_query', c.id, "Сесія обміну застаріла, почніть знову.")
+
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith('ex_month_'))
 def handle_month_selection(c):
     uid = str(c.from_user.id)
     month_key = c.data.split('_')[2]
-    data = load_data()
-    data['users'][uid]['ex_temp'] = {'month_key': month_key}
-    save_data(data)
-
-    sched = data.get(f'schedule_{month_key}', {})
-    user_dates = [d for d, u in sched.items() if u == uid]
-    if not user_dates:
-        bot.answer_callback_query(c.id)
-        bot.send_message(uid, "У вас немає чергувань у цьому місяці.")
-        return
+    conversations.set(uid, 'ex_temp', {'month_key': month_key})
 
-    kb = types.InlineKeyboardMarkup()
-    for d in user_dates:
-        d_obj = datetime.fromisoformat(d)
-        label = d_obj.strftime('%d.%m')
-        kb.add(types.InlineKeyboardButton(label, callback_data=f'ex_mydate_{d}'))
+    kb = dates_keyboard(directory.team_of(uid), f'schedule_{month_key}', uid, 'ex_mydate_')
+    if kb is None:
+        outbox.submit(c.from_user.id, 'answer_callback_query', c.id)
+        outbox.send(uid, "У вас немає чергувань у цьому місяці.")
+        return
 
     #kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data='ex_restart'))
-    bot.edit_message_text("Оберіть своє чергування:", uid, c.message.message_id, reply_markup=kb)
+    outbox.submit(uid, 'edit_message_text', "Оберіть своє чергування:", uid, c.message.message_id, reply_markup=kb)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith('ex_mydate_'))
 def handle_mydate_selection(c):
     uid = str(c.from_user.id)
     selected_date = c.data.replace('ex_mydate_', '')
-    data = load_data()
-    data['users'][uid]['ex_temp']['from'] = selected_date
-    save_data(data)
-
-    sched = data.get(f"schedule_{data['users'][uid]['ex_temp']['month_key']}", {})
-    available_uids = set(sched.values()) - {uid}
-
-    kb = types.InlineKeyboardMarkup()
-    for other_uid in available_uids:
-        user_info = data['users'].get(other_uid, {})
-        name = f"{user_info.get('emoji', '')} {user_info.get('name', f'UID {other_uid}')}"
-
-        kb.add(types.InlineKeyboardButton(name, callback_data=f'ex_user_{other_uid}'))
+    ex_temp = conversations.modify(uid, 'ex_temp', lambda ex: dict(ex, **{'from': selected_date}))
+    if not ex_temp or 'month_key' not in ex_temp:
+        return exchange_expired(c)
 
+    kb = colleagues_keyboard(directory.team_of(uid), f"schedule_{ex_temp['month_key']}", uid)
     #kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data='ex_month_back'))
-    bot.edit_message_text("Оберіть колегу для обміну:", uid, c.message.message_id, reply_markup=kb)
+    outbox.submit(uid, 'edit_message_text', "Оберіть колегу для обміну:", uid, c.message.message_id, reply_markup=kb)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith('ex_user_'))
 def handle_colleague_selection(c):
     uid = str(c.from_user.id)
     target_uid = c.data.replace('ex_user_', '')
-    data = load_data()
-
-    sched = data.get(f"schedule_{data['users'][uid]['ex_temp']['month_key']}", {})
-    target_dates = [d for d, u in sched.items() if u == target_uid]
-
-    if not target_dates:
-        bot.answer_callback_query(c.id)
-        bot.send_message(uid, "У цього колеги немає чергувань у цьому місяці.")
+    ex_temp = conversations.get(uid, 'ex_temp')
+    if not ex_temp or 'from' not in ex_temp:
+        return exchange_expired(c)
+
+    kb = dates_keyboard(directory.team_of(uid), f"schedule_{ex_temp['month_key']}", target_uid, 'ex_targetdate_')
+    if kb is None:
+        outbox.submit(c.from_user.id, 'answer_callback_query', c.id)
+        outbox.send(uid, "У цього колеги немає чергувань у цьому місяці.")
         return
 
-    data['users'][uid]['ex_temp']['target'] = target_uid
-    save_data(data)
-
-    kb = types.InlineKeyboardMarkup()
-    for d in target_dates:
-        d_obj = datetime.fromisoformat(d)
-        label = d_obj.strftime('%d.%m')
-        kb.add(types.InlineKeyboardButton(label, callback_data=f'ex_targetdate_{d}'))
+    conversations.modify(uid, 'ex_temp', lambda ex: dict(ex, target=target_uid))
 
    # kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data='ex_user_back'))
-    bot.edit_message_text("Оберіть дату чергування колеги:", uid, c.message.message_id, reply_markup=kb)
+    outbox.submit(uid, 'edit_message_text', "Оберіть дату чергування колеги:", uid, c.message.message_id, reply_markup=kb)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith('ex_targetdate_'))
 def handle_target_date_selection(c):
     uid = str(c.from_user.id)
     to_date = c.data.replace('ex_targetdate_', '')
-    data = load_data()
-    ex = data['users'][uid].pop('ex_temp', {})
+    ex = conversations.pop(uid, 'ex_temp')
+    if not ex or 'target' not in ex:
+        return exchange_expired(c)
     from_date = ex['from']
     target_uid = ex['target']
 
-    exchange_requests[uid] = {'from': from_date, 'to': to_date, 'target': target_uid}
+    # Окремий запис на кожну дату, тож другий запит не затирає перший
+    conversations.set(uid, f'exchange:{from_date}', {'from': from_date, 'to': to_date, 'target': target_uid,
+                                                     'key': f"schedule_{ex['month_key']}"}, ttl=EXCHANGE_TTL)
 
     kb = types.InlineKeyboardMarkup()
     kb.add(
-        types.InlineKeyboardButton("✅ Так", callback_data=f"ex_yes_{uid}"),
-        types.InlineKeyboardButton("❌ Ні", callback_data=f"ex_no_{uid}")
+        types.InlineKeyboardButton("✅ Так", callback_data=f"ex_yes_{uid}_{from_date}"),
+        types.InlineKeyboardButton("❌ Ні", callback_data=f"ex_no_{uid}_{from_date}")
     )
 
-    bot.send_message(
+    outbox.send(
         int(target_uid),
-        f"{data['users'][uid]['name']} пропонує обмін:\n"
+        f"{store_of(uid).get_user(uid)['name']} пропонує обмін:\n"
         f"🔁 Ваше чергування {to_date[8:]}.{to_date[5:7]} "
         f"↔ його(її) {from_date[8:]}.{from_date[5:7]}\nПогоджуєтесь?",
         reply_markup=kb
     )
-    bot.send_message(uid, "Запит надіслано колезі.")
+    outbox.send(uid, "Запит надіслано колезі.")
 
 @bot.callback_query_handler(func=lambda c: c.data == 'ex_restart')
 def handle_restart(c):
     uid = str(c.from_user.id)
-    data = load_data()
-    data['users'][uid]['ex_temp'] = {}
-    save_data(data)
+    conversations.set(uid, 'ex_temp', {})
 
     kb = types.InlineKeyboardMarkup()
     kb.add(
         types.InlineKeyboardButton("📅 Поточний місяць", callback_data='ex_month_current'),
         types.InlineKeyboardButton("📅 Наступний місяць", callback_data='ex_month_next')
     )
-    bot.edit_message_text("Оберіть місяць для обміну чергуванням:", uid, c.message.message_id, reply_markup=kb)
+    outbox.submit(uid, 'edit_message_text', "Оберіть місяць для обміну чергуванням:", uid, c.message.message_id, reply_markup=kb)
 
 
 @bot.callback_query_handler(func=lambda c: c.data == 'ex_month_back')
@@ -346,112 +1061,239 @@ def handle_back_to_month(c):
 @bot.callback_query_handler(func=lambda c: c.data == 'ex_user_back')
 def handle_back_to_user_dates(c):
     uid = str(c.from_user.id)
-    data = load_data()
-    ex_temp = data['users'][uid].get('ex_temp', {})
+    ex_temp = conversations.get(uid, 'ex_temp', {})
     from_date = ex_temp.get('from')
     if not from_date:
         return handle_restart(c)
 
-    sched = data.get(f"schedule_{ex_temp['month_key']}", {})
-    available_uids = set(sched.values()) - {uid}
-    kb = types.InlineKeyboardMarkup()
-    for other_uid in available_uids:
-        name = data['users'].get(other_uid, {}).get('name', f"UID {other_uid}")
-        kb.add(types.InlineKeyboardButton(name, callback_data=f'ex_user_{other_uid}'))
+    kb = colleagues_keyboard(directory.team_of(uid), f"schedule_{ex_temp['month_key']}", uid)
     #kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data='ex_month_back'))
 
-    bot.edit_message_text("Оберіть колегу для обміну:", uid, c.message.message_id, reply_markup=kb)
+    outbox.submit(uid, 'edit_message_text', "Оберіть колегу для обміну:", uid, c.message.message_id, reply_markup=kb)
 
 
 
 def process_exchange_from(msg):
     if msg.text == 'Скасувати': return cmd_cancel(msg)
     uid = str(msg.chat.id)
+    store = store_of(uid)
     try:
         day, mon = map(int, msg.text.strip().split('.'))
-        data = load_data()
-        sched = data.get('schedule_current', {})
+        sched = store.schedule('schedule_current')
         if not sched:
-            bot.send_message(msg.chat.id, "Спочатку згенеруйте розклад.", reply_markup=build_main_menu())
+            outbox.send(msg.chat.id, "Спочатку згенеруйте розклад.", reply_markup=MAIN_MENU)
             return
         first_iso = next(iter(sched))
         sched_dt = datetime.fromisoformat(first_iso)
         year, month = sched_dt.year, sched_dt.month
         dt_obj = date(year, month, day)
         frm = dt_obj.isoformat()
-        if sched.get(frm) != uid:
-            bot.send_message(msg.chat.id, "У вас немає чергування на цю дату.", reply_markup=build_main_menu())
+        if store.on_duty('schedule_current', frm) != uid:
+            outbox.send(msg.chat.id, "У вас немає чергування на цю дату.", reply_markup=MAIN_MENU)
             return
-        data['users'][uid].setdefault('ex_temp', {})['from'] = frm
-        save_data(data)
-        sent = bot.send_message(msg.chat.id, "Введіть дату колеги (dd.mm):")
-        bot.register_next_step_handler(sent, process_exchange_to)
+        conversations.set(uid, 'ex_temp', dict(conversations.get(uid, 'ex_temp', {}), **{'from': frm}))
+        bot.register_next_step_handler_by_chat_id(msg.chat.id, process_exchange_to)
+        outbox.send(msg.chat.id, "Введіть дату колеги (dd.mm):")
     except ValueError:
-        sent = bot.send_message(msg.chat.id, "Невірний формат dd.mm:")
-        bot.register_next_step_handler(sent, process_exchange_from)
+        bot.register_next_step_handler_by_chat_id(msg.chat.id, process_exchange_from)
+        outbox.send(msg.chat.id, "Невірний формат dd.mm:")
 
 def process_exchange_to(msg):
     if msg.text == 'Скасувати': return cmd_cancel(msg)
     uid = str(msg.chat.id)
+    store = store_of(uid)
     try:
         day, mon = map(int, msg.text.strip().split('.'))
-        data = load_data()
-        sched = data.get('schedule_current', {})
+        sched = store.schedule('schedule_current')
         first_iso = next(iter(sched))
         sched_dt = datetime.fromisoformat(first_iso)
         year, month = sched_dt.year, sched_dt.month
         dt_obj = date(year, month, day)
         to_dt = dt_obj.isoformat()
-        ex = data['users'][uid].pop('ex_temp', {})
+        ex = conversations.pop(uid, 'ex_temp', {})
         ex['to'] = to_dt
-        tgt = sched.get(to_dt)
+        tgt = store.on_duty('schedule_current', to_dt)
         if not tgt or tgt == uid:
-            bot.send_message(msg.chat.id, "Немає колеги на цю дату.", reply_markup=build_main_menu())
+            outbox.send(msg.chat.id, "Немає колеги на цю дату.", reply_markup=MAIN_MENU)
             return
-        exchange_requests[uid] = {'from': ex['from'], 'to': to_dt, 'target': tgt}
+        conversations.set(uid, f"exchange:{ex['from']}", {'from': ex['from'], 'to': to_dt, 'target': tgt,
+                                                          'key': 'schedule_current'}, ttl=EXCHANGE_TTL)
         kb = types.InlineKeyboardMarkup()
         kb.add(
-            types.InlineKeyboardButton("Так", callback_data=f"ex_yes_{uid}"),
-            types.InlineKeyboardButton("Ні", callback_data=f"ex_no_{uid}")
+            types.InlineKeyboardButton("Так", callback_data=f"ex_yes_{uid}_{ex['from']}"),
+            types.InlineKeyboardButton("Ні", callback_data=f"ex_no_{uid}_{ex['from']}")
         )
-        bot.send_message(
+        outbox.send(
             int(tgt),
-            f"{data['users'][uid]['name']} пропонує обмін: ваш {to_dt[8:]} ↔ його(її) {ex['from'][8:]}. Погоджуєтесь?",
+            f"{store.get_user(uid)['name']} пропонує обмін: ваш {to_dt[8:]} ↔ його(її) {ex['from'][8:]}. Погоджуєтесь?",
             reply_markup=kb
         )
-        bot.send_message(msg.chat.id, "Запит відправлено.", reply_markup=build_main_menu())
+        outbox.send(msg.chat.id, "Запит відправлено.", reply_markup=MAIN_MENU)
     except ValueError:
-        sent = bot.send_message(msg.chat.id, "Невірний формат dd.mm:")
-        bot.register_next_step_handler(sent, process_exchange_to)
+        bot.register_next_step_handler_by_chat_id(msg.chat.id, process_exchange_to)
+        outbox.send(msg.chat.id, "Невірний формат dd.mm:")
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith('ex_'))
 def handle_exchange_callback(c):
-    _, action, uid = c.data.split('_')
-    req = exchange_requests.pop(uid, None)
+    # ex_yes_<uid>_<дата>; на кнопки без дати (до оновлення) запиту вже давно немає
+    _, action, uid, *date_part = c.data.split('_')
+    req = conversations.pop(uid, f'exchange:{date_part[0]}') if date_part else None
 
     if not req:
-        bot.answer_callback_query(c.id, "Запит не знайдено.")
+        outbox.submit(c.from_user.id, 'answer_callback_query', c.id, "Запит не знайдено.")
         return
 
-    data = load_data()
-    sched = data.get('schedule_current', {})
-    data['schedule_current'] = sched  # гарантія оновлення
-
     fr, to_dt, tgt = req['from'], req['to'], req['target']
+    team = directory.team_of(uid)
 
     if action == 'yes':
-        # Обмін місцями
-        sched[fr], sched[to_dt] = tgt, uid
-
-        save_data(data)  # обов’язкове збереження після оновлення
-        bot.send_message(int(uid), f"✅ Обмін підтверджено! Ваш новий день чергування: {to_dt[8:]}")
-        bot.send_message(int(tgt), f"✅ Ви погодились на обмін. Ваш новий день чергування: {fr[8:]}")
+        # Обмін місцями - лише якщо обидва дні досі за тими, хто домовлявся
+        try:
+            stores.get(team).swap(req.get('key', 'schedule_current'), fr, to_dt, uid, tgt)
+        except Conflict:
+            outbox.send(int(uid), "⚠️ Розклад змінився, обмін не виконано.")
+            outbox.send(int(tgt), "⚠️ Розклад змінився, обмін не виконано.")
+        else:
+            schedule_reminders(team)
+            outbox.send(int(uid), f"✅ Обмін підтверджено! Ваш новий день чергування: {to_dt[8:]}")
+            outbox.send(int(tgt), f"✅ Ви погодились на обмін. Ваш новий день чергування: {fr[8:]}")
     else:
-        bot.send_message(int(uid), "❌ Колега відхилив обмін.")
-        bot.send_message(int(tgt), "Ви відхилили запит на обмін.")
+        outbox.send(int(uid), "❌ Колега відхилив обмін.")
+        outbox.send(int(tgt), "Ви відхилили запит на обмін.")
+
+    outbox.submit(c.from_user.id, 'answer_callback_query', c.id)
+
+# --- Swap Market Handlers ---
+# Пропозиція: "віддаю свою дату X, візьму будь-яку з обраних (або будь-яку взагалі)".
+# Публікація - це й згода: щойно знайдеться пара чи ланцюг, обмін виконується одразу
+def take_keyboard(team, uid, selected):
+    store = stores.get(team)
+    today = datetime.now(pytz.timezone(TIMEZONE)).date().isoformat()
+    dates = sorted(iso for key in ('schedule_current', 'schedule_next')
+                   for iso, holder in store.schedule(key).items() if holder != uid and iso > today)
+    kb = types.InlineKeyboardMarkup(row_width=5)
+    kb.add(*[types.InlineKeyboardButton(f"{'✅' if iso in selected else ''}{iso[8:]}.{iso[5:7]}",
+                                        callback_data=f'mk_take_{iso}') for iso in dates])
+    kb.row(types.InlineKeyboardButton("Будь-яка дата", callback_data='mk_any'),
+           types.InlineKeyboardButton("Опублікувати", callback_data='mk_post'))
+    return kb
 
-    bot.answer_callback_query(c.id)
+
+@bot.message_handler(func=lambda m: m.text == 'Біржа обмінів', chat_types=['private'])
+def cmd_market(msg):
+    team = directory.team_of(msg.from_user.id)
+    with market_lock(team):
+        open_offers = len(offer_book(team))
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("➕ Запропонувати обмін", callback_data='mk_new'),
+           types.InlineKeyboardButton("📋 Мої пропозиції", callback_data='mk_mine'))
+    outbox.send(msg.chat.id, f"Біржа обмінів: відкритих пропозицій - {open_offers}.\n"
+                             "Вкажіть, яке чергування віддаєте і які дати готові взяти замість нього - "
+                             "обмін (і навіть ланцюжок з кількох людей) виконається, щойно знайдеться пара.",
+                reply_markup=kb)
+
+@bot.callback_query_handler(func=lambda c: c.data == 'mk_new')
+def handle_market_new(c):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("📅 Поточний місяць", callback_data='mk_month_current'),
+           types.InlineKeyboardButton("📅 Наступний місяць", callback_data='mk_month_next'))
+    outbox.submit(c.from_user.id, 'edit_message_text', "З якого місяця віддаєте чергування?",
+                  c.from_user.id, c.message.message_id, reply_markup=kb)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('mk_month_'))
+def handle_market_month(c):
+    uid = str(c.from_user.id)
+    key = f"schedule_{c.data.replace('mk_month_', '')}"
+    today = datetime.now(pytz.timezone(TIMEZONE)).date().isoformat()
+    kb = dates_keyboard(directory.team_of(uid), key, uid, 'mk_give_', after=today)
+    if kb is None:
+        outbox.submit(c.from_user.id, 'answer_callback_query', c.id, "У вас немає майбутніх чергувань у цьому місяці.")
+        return
+    conversations.set(uid, 'mk_temp', {'key': key})
+    outbox.submit(uid, 'edit_message_text', "Яке чергування віддаєте?", uid, c.message.message_id, reply_markup=kb)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('mk_give_'))
+def handle_market_give(c):
+    uid = str(c.from_user.id)
+    temp = conversations.modify(uid, 'mk_temp', lambda t: dict(t, give=c.data.replace('mk_give_', ''), take=[]))
+    if not temp:
+        return exchange_expired(c)
+    kb = take_keyboard(directory.team_of(uid), uid, set())
+    outbox.submit(uid, 'edit_message_text', "Які дати готові взяти замість нього? Оберіть одну чи кілька.",
+                  uid, c.message.message_id, reply_markup=kb)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('mk_take_'))
+def handle_market_take(c):
+    uid, iso = str(c.from_user.id), c.data.replace('mk_take_', '')
+    toggle = lambda t: dict(t, take=sorted(set(t['take']) ^ {iso}))
+    temp = conversations.modify(uid, 'mk_temp', lambda t: toggle(t) if 'take' in t else t)
+    if not temp or 'take' not in temp:
+        return exchange_expired(c)
+    kb = take_keyboard(directory.team_of(uid), uid, set(temp['take']))
+    outbox.submit(uid, 'edit_message_reply_markup', uid, c.message.message_id, reply_markup=kb)
+    outbox.submit(c.from_user.id, 'answer_callback_query', c.id)
+
+@bot.callback_query_handler(func=lambda c: c.data in ('mk_any', 'mk_post'))
+def handle_market_post(c):
+    uid = str(c.from_user.id)
+    if c.data == 'mk_post' and not conversations.get(uid, 'mk_temp', {}).get('take', True):
+        outbox.submit(c.from_user.id, 'answer_callback_query', c.id, "Оберіть хоча б одну дату або «Будь-яка дата».")
+        return
+    temp = conversations.pop(uid, 'mk_temp')  # pop: подвійне натискання не опублікує двічі
+    if not temp or 'give' not in temp:
+        return exchange_expired(c)
+    take = None if c.data == 'mk_any' else temp['take']
+    try:
+        _, cycle = post_offer(directory.team_of(uid), uid, temp['key'], temp['give'], take)
+    except Conflict:
+        outbox.submit(uid, 'edit_message_text', "Це чергування вже не ваше, пропозицію не опубліковано.",
+                      uid, c.message.message_id)
+        return
+    except ValueError:
+        outbox.submit(uid, 'edit_message_text', "Ця дата вже настала, обміняти її не можна.",
+                      uid, c.message.message_id)
+        return
+    text = "Пару знайдено одразу!" if cycle else "Пропозицію опубліковано. Повідомлю, щойно знайдеться обмін."
+    outbox.submit(uid, 'edit_message_text', text, uid, c.message.message_id)
+
+@bot.callback_query_handler(func=lambda c: c.data == 'mk_mine' or c.data.startswith('mk_del_'))
+def handle_market_mine(c):
+    uid = str(c.from_user.id)
+    team = directory.team_of(uid)
+    if c.data.startswith('mk_del_'):
+        withdraw_offer(team, uid, c.data.replace('mk_del_', ''))
+    with market_lock(team):
+        offers = offer_book(team).of_user(uid)
+    if not offers:
+        outbox.submit(uid, 'edit_message_text', "У вас немає відкритих пропозицій.", uid, c.message.message_id)
+        return
+    kb = types.InlineKeyboardMarkup()
+    for o in offers:
+        wants = 'будь-яка дата' if o.take is None else ', '.join(f'{d[8:]}.{d[5:7]}' for d in sorted(o.take)[:6]) + \
+            ('…' if len(o.take) > 6 else '')
+        kb.add(types.InlineKeyboardButton(f"❌ {o.give[8:]}.{o.give[5:7]} → {wants}", callback_data=f'mk_del_{o.oid}'))
+    outbox.submit(uid, 'edit_message_text', "Ваші пропозиції (натисніть, щоб зняти):", uid, c.message.message_id,
+                  reply_markup=kb)
 
 
 if __name__ == '__main__':
-    bot.infinity_polling(none_stop=True)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    if METRICS_LOG_INTERVAL:
+        metrics.start_log_summary(METRICS_LOG_INTERVAL)
+    # docker stop / systemctl stop шлють SIGTERM: перетворити його на SystemExit, щоб finally
+    # дописав журнал і чергу відправки (aiohttp у режимі вебхука ставить власний обробник)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    warm_up_timer = threading.Timer(STARTUP_DEFER, request_warm_up)
+    warm_up_timer.daemon = True
+    warm_up_timer.start()
+    try:
+        if RUN_MODE == 'webhook':
+            from webhook import run_webhook
+            run_webhook(bot, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, url=WEBHOOK_URL, secret=WEBHOOK_SECRET)
+        else:
+            bot.infinity_polling(none_stop=True)
+    finally:
+        outbox.close()
+        conversations.save()
+        stores.close()
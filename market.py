@@ -0,0 +1,94 @@
+from collections import namedtuple
+
+# give - дата, яку людина віддає (з розкладу key); take - дати, які вона готова взяти
+# замість неї (з будь-якого з двох місяців), або None - будь-яку
+Offer = namedtuple('Offer', 'oid uid key give take ts')
+
+
+def offer_from_dict(oid, data):
+    take = data.get('take')
+    return Offer(str(oid), data['uid'], data['key'], data['give'], None if take is None else frozenset(take), data['ts'])
+
+
+# Книга пропозицій біржі обмінів з індексами за датою, яку віддають, за людиною і за
+# бажаною датою. Обмін - цикл c0 -> c1 -> ... -> c0, де кожен ci бере дату c(i+1):
+# цикл з двох - звичайний обмін, довші - A→B→C→A. Пошук іде лише від нової пропозиції
+# і лише по ребрах з індексів, тож тисячі відкритих пропозицій не перебираються повністю
+class OfferBook:
+    def __init__(self, offers=(), version=None):
+        self.version = version  # версія 'offers' у сховищі, з якої зібрано книгу
+        self.offers = {}
+        self.by_give = {}  # дата -> {oid}
+        self.by_uid = {}  # uid -> {oid}
+        self.wanted = {}  # дата -> {oid}, хто готовий її взяти
+        self.anything = set()  # oid з take=None
+        for offer in offers:
+            self.add(offer)
+
+    def __len__(self):
+        return len(self.offers)
+
+    def add(self, offer):
+        self.offers[offer.oid] = offer
+        self.by_give.setdefault(offer.give, set()).add(offer.oid)
+        self.by_uid.setdefault(offer.uid, set()).add(offer.oid)
+        if offer.take is None:
+            self.anything.add(offer.oid)
+        else:
+            for iso in offer.take:
+                self.wanted.setdefault(iso, set()).add(offer.oid)
+
+    def remove(self, oid):
+        offer = self.offers.pop(oid, None)
+        if offer is None:
+            return
+        for index, key in ((self.by_give, offer.give), (self.by_uid, offer.uid)):
+            index[key].discard(oid)
+            if not index[key]:
+                del index[key]
+        self.anything.discard(oid)
+        for iso in offer.take or ():
+            self.wanted[iso].discard(oid)
+            if not self.wanted[iso]:
+                del self.wanted[iso]
+
+    def of_user(self, uid):
+        return sorted((self.offers[oid] for oid in self.by_uid.get(uid, ())), key=lambda o: o.give)
+
+    def _sources(self, offer):
+        # Пропозиції, чию дату offer готовий узяти
+        if offer.take is None:
+            return self.offers.values()
+        return [self.offers[oid] for iso in sorted(offer.take) for oid in self.by_give.get(iso, ())]
+
+    def find_cycle(self, oid, valid, max_len=3, budget=20000):
+        # Найкоротший цикл через oid (спершу пари, далі трійки...), серед рівних - зі старших пропозицій.
+        # budget обмежує кількість переглянутих ребер, якщо багато хто згоден на будь-яку дату
+        # valid(taker, giver): чи може taker узяти дату giver (дата ще за ним, не у відпустці тощо)
+        start = self.offers.get(oid)
+        if start is None:
+            return None
+        closing = self.wanted.get(start.give, set()) | self.anything
+        paths = [[start]]
+        for length in range(2, max_len + 1):
+            grown = []
+            for path in paths:
+                last, uids = path[-1], {o.uid for o in path}
+                for nxt in self._sources(last):
+                    budget -= 1
+                    if budget <= 0:
+                        return None
+                    if nxt.uid in uids or not valid(last, nxt):
+                        continue
+                    if nxt.oid in closing and valid(nxt, start):
+                        return path + [nxt]
+                    if length < max_len:
+                        grown.append(path + [nxt])
+            paths = grown
+        return None
+
+
+def moves(cycle):
+    # Цикл -> [(key, дата, хто віддає, хто бере)]
+    return [(giver.key, giver.give, giver.uid, taker.uid)
+            for taker, giver in zip(cycle, cycle[1:] + cycle[:1])]
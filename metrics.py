@@ -0,0 +1,202 @@
+import sys
+import time
+import bisect
+import logging
+import threading
+import functools
+import traceback
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Верхня межа кошика, в який потрапляє квантиль - для зведення в лог цього досить
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank and n:
+                return bound
+        return 0.0
+
+
+# Лічильники, гістограми і датчики процесу в одному місці; віддаються у форматі Prometheus.
+# Кожне спостереження - одна операція під коротким локом, тож можна тримати ввімкненим завжди
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.help = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def gauge(self, name, fn, doc=None):
+        self.gauges[name] = fn
+        if doc:
+            self.help[name] = doc
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t, **labels)
+
+    def timed(self, name):
+        def wrap(fn):
+            @functools.wraps(fn)
+            def inner(*args, **kwargs):
+                with self.timer(name):
+                    return fn(*args, **kwargs)
+            return inner
+        return wrap
+
+    # --- Export ---
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, h.buckets, list(h.counts), h.sum, h.count) for key, h in sorted(self.histograms.items())]
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{_labels(labels)} {value}')
+        for (name, labels), buckets, counts, total, count in histograms:
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            seen = 0
+            for bound, n in zip(buckets, counts):
+                seen += n
+                lines.append(f'{name}_bucket{_labels(labels + (("le", repr(bound)),))} {seen}')
+            lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if name in self.help:
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        with self.lock:
+            items = sorted((k, h.count, h.sum, h.quantile(0.95)) for k, h in self.histograms.items())
+        return '; '.join(f'{name}{_labels(labels)} n={n} avg={total / n * 1000:.1f}ms p95<={p95 * 1000:.0f}ms'
+                         for (name, labels), n, total, p95 in items if n)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' '))
+                          for k, v in labels) + '}'
+
+
+registry = Registry()
+
+
+def serve(port, host='127.0.0.1'):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            payload = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+def start_log_summary(interval):
+    def loop():
+        while True:
+            time.sleep(interval)
+            text = registry.summary()
+            if text:
+                logger.info('metrics: %s', text)
+    threading.Thread(target=loop, name='metrics-log', daemon=True).start()
+
+
+# Опційний профайлер: якщо хендлер виконується довше порогу, сторожовий потік
+# знімає стек його потоку і пише в лог, де саме він застряг
+class SlowCallProfiler:
+    def __init__(self, threshold, interval=None):
+        self.threshold = threshold
+        self.interval = interval or max(threshold / 4, 0.005)
+        self.active = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self._watch, name='slow-profiler', daemon=True).start()
+
+    @contextmanager
+    def track(self, label):
+        tid = threading.get_ident()
+        with self.lock:
+            self.active[tid] = [label, time.perf_counter(), False]
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active.pop(tid, None)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self.lock:
+                slow = [(tid, entry) for tid, entry in self.active.items()
+                        if not entry[2] and now - entry[1] > self.threshold]
+                for _, entry in slow:
+                    entry[2] = True
+            frames = sys._current_frames()
+            for tid, (label, started, _) in slow:
+                frame = frames.get(tid)
+                if frame is not None:
+                    registry.inc('slow_handler_samples_total', handler=label)
+                    logger.warning('Slow handler %s (%.0f ms so far):\n%s', label, (now - started) * 1000,
+                                   ''.join(traceback.format_stack(frame)))
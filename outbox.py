@@ -0,0 +1,234 @@
+import time
+import heapq
+import queue
+import logging
+import itertools
+import threading
+import requests
+from telebot.apihelper import ApiTelegramException
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE, BULK = 0, 1
+UNMETERED = {'answer_callback_query'}  # не повідомлення в чат, ліміт чату на них не діє
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # Забирає токен (можна в борг) і повертає, скільки секунд чекати до відправки
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def take(self):
+        # Без боргу: 0, якщо токен є (і забрати його), інакше - через скільки він з'явиться
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def idle(self):
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.last) * self.rate >= self.capacity
+
+
+# Черга одного воркера: вхідна PriorityQueue і відкладені запити чатів, що вичерпали свій ліміт
+# (чат -> купа за пріоритетом і порядком). Разом не більше limit запитів у кожній з двох
+class Lane:
+    def __init__(self, limit):
+        self.limit = limit
+        self.queue = queue.PriorityQueue(limit)
+        self.held = {}
+        self.size = 0  # скільки запитів у held
+        self.timers = []  # (коли, чат): коли знову спробувати відкладений чат
+
+    def hold(self, chat, entry):
+        heapq.heappush(self.held.setdefault(chat, []), entry)
+        self.size += 1
+
+    def take(self, chat):
+        pending = self.held.get(chat)
+        if not pending:
+            return None
+        entry = heapq.heappop(pending)
+        if not pending:
+            del self.held[chat]
+        self.size -= 1
+        return entry
+
+
+# Черга вихідних запитів до Bot API. Хендлери лише ставлять запит у чергу;
+# відправляють воркери з обмеженням швидкості (загальним і на чат) і повторами на 429/5xx.
+# Усі запити одного чату йдуть через один воркер, тож порядок повідомлень у чаті зберігається.
+# Чат, що вичерпав свій ліміт, чекає у власній черзі воркера, а воркер тим часом обслуговує інші чати
+class Outbox:
+    def __init__(self, bot, workers=4, maxsize=10000, global_rate=30, chat_rate=1, chat_burst=3,
+                 retries=5, backoff=0.5, put_timeout=1.0):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.buckets_lock = threading.Lock()
+        self.retries = retries
+        self.backoff = backoff
+        self.put_timeout = put_timeout
+        self.seq = itertools.count()
+        self.lanes = [Lane(max(maxsize // workers, 1)) for _ in range(workers)]
+        self.threads = []
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        if not self.threads:
+            for i, lane in enumerate(self.lanes):
+                t = threading.Thread(target=self._worker, args=(lane,), name=f'outbox-{i}', daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def close(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        for lane in self.lanes:
+            lane.queue.put((BULK + 1, next(self.seq), None))
+        for t in self.threads:
+            t.join(max(deadline - time.monotonic(), 0))
+        self.threads = []
+
+    def pending(self):
+        return sum(lane.queue.qsize() + lane.size for lane in self.lanes)
+
+    # --- Enqueue ---
+    def submit(self, chat_id, method, *args, bulk=False, **kwargs):
+        task = (chat_id, method, args, kwargs)
+        lane = self.lanes[hash(str(chat_id)) % len(self.lanes)]
+        try:
+            lane.queue.put((BULK if bulk else INTERACTIVE, next(self.seq), task), timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self._drop(method, chat_id)
+            return False
+
+    def _drop(self, method, chat_id):
+        self.dropped += 1
+        registry.inc('outbound_dropped_total', method=method)
+        logger.warning('Outbox full, dropping %s to %s', method, chat_id)
+
+    def send(self, chat_id, text, bulk=False, **kwargs):
+        return self.submit(chat_id, 'send_message', chat_id, text, bulk=bulk, **kwargs)
+
+    # --- Delivery ---
+    def _chat_bucket(self, chat_id):
+        chat_id = str(chat_id)
+        with self.buckets_lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) > 10000:
+                    self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle()}
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+
+    def _worker(self, lane):
+        timers = lane.timers
+        closing = False
+        while True:
+            now = time.monotonic()
+            if timers and timers[0][0] <= now:
+                self._release(lane, heapq.heappop(timers)[1])
+                continue
+            if closing:
+                if not timers:
+                    return
+                time.sleep(timers[0][0] - now)  # дочекатися і дописати відкладене
+                continue
+            try:
+                prio, seq, task = lane.queue.get(timeout=timers[0][0] - now if timers else None)
+            except queue.Empty:
+                continue
+            if task is None:
+                closing = True
+                continue
+            chat, entry = str(task[0]), [prio, seq, task, 0, 0.0]
+            if chat in lane.held and task[1] not in UNMETERED:
+                # після вже відкладених запитів чату; понад ліміт - як і при повній черзі, відкинути
+                if lane.size >= lane.limit:
+                    self._drop(task[1], task[0])
+                else:
+                    lane.hold(chat, entry)
+            else:
+                self._attempt(lane, chat, entry)
+
+    def _release(self, lane, chat):
+        entry = lane.take(chat)
+        if entry is None:
+            return
+        if not self._attempt(lane, chat, entry, retry=True) and chat in lane.held:
+            heapq.heappush(lane.timers, (time.monotonic(), chat))
+
+    def _attempt(self, lane, chat, entry, retry=False):
+        # Надіслати зараз або відкласти в lane.held (ліміт чату чи пауза перед повтором); True - відкладено.
+        # Новий запит понад ліміт відкладених відкидається; уже відкладений (retry) своє місце зберігає
+        prio, seq, task, attempt, not_before = entry
+        wait = not_before - time.monotonic()
+        if wait <= 0 and task[1] not in UNMETERED:
+            wait = self._chat_bucket(chat).take()
+        if wait <= 0:
+            wait = self._deliver(*task, attempt)
+            if wait is None:
+                return False
+            entry = [prio, seq, task, attempt + 1, time.monotonic() + wait]
+        if not retry and lane.size >= lane.limit:
+            self._drop(task[1], task[0])
+            return False
+        lane.hold(chat, entry)
+        heapq.heappush(lane.timers, (time.monotonic() + wait, chat))
+        return True
+
+    def _deliver(self, chat_id, method, args, kwargs, attempt):
+        # Одна спроба; повертає паузу перед повтором або None (надіслано чи остаточно відмовлено)
+        wait = self.global_bucket.reserve()
+        if wait:
+            time.sleep(wait)
+        started = time.perf_counter()
+        delay = None
+        try:
+            getattr(self.bot, method)(*args, **kwargs)
+            registry.observe('outbound_request_seconds', time.perf_counter() - started, method=method)
+            self.sent += 1
+            return None
+        except ApiTelegramException as e:
+            registry.inc('outbound_errors_total', method=method, code=e.error_code)
+            if e.error_code == 429:
+                delay = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            elif e.error_code >= 500:
+                delay = self.backoff * 2 ** attempt
+            else:
+                logger.warning('%s to %s rejected: %s', method, chat_id, e.description)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            registry.inc('outbound_errors_total', method=method, code='network')
+            delay = self.backoff * 2 ** attempt
+            logger.info('%s to %s failed: %s', method, chat_id, e)
+        except Exception:
+            registry.inc('outbound_errors_total', method=method, code='exception')
+            logger.exception('%s to %s failed', method, chat_id)
+        if delay is not None and attempt < self.retries:
+            return min(delay, 60)
+        self.failed += 1
+        registry.inc('outbound_failed_total', method=method)
+        logger.error('Giving up on %s to %s', method, chat_id)
+        return None
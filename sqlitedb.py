@@ -0,0 +1,43 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# Спільне для всіх SQLite-файлів бота (сховище, діалоги, оренда лідера): з'єднання sqlite3
+# не можна ділити між потоками, тож у кожного потоку своє, з однаковими налаштуваннями
+class LocalConnection:
+    def __init__(self, path, row_factory=None):
+        self.path = path
+        self.row_factory = row_factory
+        self._local = threading.local()
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: транзакції відкриваємо самі через transaction()
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# BEGIN IMMEDIATE бере замок на запис одразу: читання всередині вже бачить остаточні дані,
+# і два процеси не впираються в SQLITE_BUSY посеред транзакції
+@contextmanager
+def transaction(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
@@ -0,0 +1,797 @@
+import os
+import sys
+import copy
+import json
+import atexit
+import time
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from metrics import registry
+from sqlitedb import LocalConnection, transaction
+
+
+MISSING = object()
+
+
+class Conflict(Exception):
+    pass
+
+
+def check_expected(current, expected):
+    # Порівняти-і-замінити: поля мають досі мати ті значення, які бачив хендлер
+    for field, value in (expected or {}).items():
+        if current.get(field, MISSING) != value:
+            raise Conflict(field)
+
+
+def empty_data():
+    return {'users': {}, 'schedule_current': {}, 'schedule_next': {}, 'offers': {}}
+
+
+def atomic_write(path, payload):
+    # Пишемо у тимчасовий файл поруч і підміняємо, щоб data.json ніколи не був напівзаписаним
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp-', suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(payload)
+
+
+def read_jsonl(path):
+    # Записи JSONL-файлу, що лише дописується. Обірваний хвіст після аварійної зупинки
+    # обрізається: інакше наступний допис злився б із ним в один зіпсований рядок
+    # і пропав би при наступному відновленні разом з усім, що після нього
+    records, good = [], 0
+    with open(path, 'r+b') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            good += len(line)
+        if good < f.seek(0, os.SEEK_END):
+            f.truncate(good)
+            f.flush()
+            os.fsync(f.fileno())
+            registry.inc('journal_truncated_total')
+    return records
+
+
+# Інтерфейс сховища: хендлери працюють лише через ці методи
+class Store(ABC):
+    def start(self): pass
+    def close(self): pass
+    def flush(self): return 0
+
+    @abstractmethod
+    def users(self): ...
+    @abstractmethod
+    def get_user(self, uid): ...
+    @abstractmethod
+    def update_user(self, uid, expected=None, **fields): ...
+    @abstractmethod
+    def register_user(self, uid, emoji, reminder_time): ...
+    @abstractmethod
+    def add_vacation(self, uid, vac): ...
+    @abstractmethod
+    def remove_user(self, uid): ...
+    @abstractmethod
+    def import_rows(self, rows, defaults): ...
+
+    @abstractmethod
+    def schedule(self, key): ...
+    @abstractmethod
+    def set_schedule(self, key, sched): ...
+    @abstractmethod
+    def swap(self, key, fr, to_dt, uid, tgt): ...
+    @abstractmethod
+    def user_dates(self, key, uid): ...
+    @abstractmethod
+    def duty_uids(self, key): ...
+    @abstractmethod
+    def on_duty(self, key, iso): ...
+    @abstractmethod
+    def duty_counts(self, key): ...
+    @abstractmethod
+    def reassign(self, key, changes, old_uid): ...
+    @abstractmethod
+    def month_duties(self, month): ...
+
+    # Біржа обмінів: пропозиції живуть поруч із розкладом і зникають, щойно дата змінила власника
+    @abstractmethod
+    def offers(self): ...
+    @abstractmethod
+    def post_offer(self, uid, key, give, take): ...
+    @abstractmethod
+    def withdraw_offer(self, oid, uid): ...
+    @abstractmethod
+    def trade(self, moves, oids): ...
+    @abstractmethod
+    def expire_offers(self, today): ...
+
+    # Лічильники змін: 'users' (профілі) і окремо кожен розклад; ростуть при кожній зміні
+    @abstractmethod
+    def versions(self, *names): ...
+
+
+# --- Journal ---
+# Кожна зміна - один компактний запис у журналі; той самий код застосовує її
+# і в пам'яті, і під час відновлення зі снапшота
+def touched(event):
+    # Які лічильники версій зачіпає подія; відпустки на відображення не впливають
+    op = event['op']
+    if op in ('user_updated', 'user_registered', 'field_removed', 'user_removed', 'batch_imported'):
+        names = ('users',)
+    elif op == 'trade_applied':
+        names = tuple(sorted({move[0] for move in event['moves']}))
+    else:
+        names = (event['key'],) if 'key' in event and not op.startswith('offer_') else ()
+    if op.startswith('offer_') or op == 'trade_applied' or event.get('dropped'):
+        names += ('offers',)
+    return names
+
+
+def apply_event(data, event):
+    op = event['op']
+    users = data['users']
+    if op == 'user_updated':
+        users.setdefault(event['uid'], {}).update(event['fields'])
+    elif op == 'user_registered':
+        user = users.setdefault(event['uid'], {})
+        user['emoji'] = event['emoji']
+        user['reminder_time'] = dict(event['reminder_time'])
+        user.setdefault('vacation', [])
+    elif op == 'field_removed':  # лише зі старих журналів: нові такого запису не пишуть
+        users.get(event['uid'], {}).pop(event['field'], None)
+    elif op == 'vacation_added':
+        users.setdefault(event['uid'], {}).setdefault('vacation', []).append(
+            {'from': event['from'], 'to': event['to']})
+    elif op == 'schedule_generated':
+        data[event['key']] = dict(event['schedule'])
+    elif op == 'user_removed':
+        users.pop(event['uid'], None)
+    elif op == 'batch_imported':
+        for uid, fields in event['users'].items():
+            user = users.setdefault(uid, {})
+            user.setdefault('vacation', [])
+            user.update(fields)
+        for uid, start, end in event['vacations']:
+            users.setdefault(uid, {}).setdefault('vacation', []).append({'from': start, 'to': end})
+    elif op == 'duties_reassigned':
+        sched = dict(data.get(event['key'], {}))
+        sched.update(event['changes'])
+        data[event['key']] = sched
+    elif op == 'duty_swapped':
+        # Новий dict замість зміни на місці, щоб читачі не бачили пів-обміну
+        sched = dict(data.get(event['key'], {}))
+        sched[event['from']], sched[event['to']] = event['target'], event['uid']
+        data[event['key']] = sched
+    elif op == 'offer_posted':
+        data.setdefault('offers', {})[event['oid']] = event['offer']
+    elif op == 'offer_withdrawn':
+        data.setdefault('offers', {}).pop(event['oid'], None)
+    elif op == 'offer_expired':
+        pass  # самі пропозиції - у 'dropped'
+    elif op == 'trade_applied':
+        changed = {}
+        for key, iso, _, new_uid in event['moves']:
+            changed.setdefault(key, dict(data.get(key, {})))[iso] = new_uid
+        data.update(changed)
+    else:
+        raise ValueError(f'Unknown journal event: {op}')
+    # Пропозиції біржі, чиї дати щойно змінили власника, - перелічені в самій події
+    for oid in event.get('dropped', ()):
+        data.setdefault('offers', {}).pop(oid, None)
+
+
+# Стан у пам'яті процесу = снапшот data.json + журнал змін data.journal.
+# Записи журналу дописуються пачками раз на flush_interval секунд і під час
+# зупинки; коли журнал перевищує compact_bytes, він згортається в новий снапшот
+class JsonStore(Store):
+    def __init__(self, path, journal_path=None, flush_interval=2.0, compact_bytes=1 << 20):
+        self.path = path
+        self.journal_path = journal_path or os.path.splitext(path)[0] + '.journal'
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+        self.lock = threading.RLock()
+        self.io_lock = threading.Lock()
+        self.pending = []
+        self._versions = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.data, self.seq = self._read()
+
+    def _read(self):
+        with registry.timer('store_load_seconds'):
+            return self._replay()
+
+    def _replay(self):
+        data, seq = empty_data(), 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data.update(json.load(f))
+            seq = data.pop('seq', 0)
+            self._versions = data.pop('versions', {})
+        if os.path.exists(self.journal_path):
+            for event in read_jsonl(self.journal_path):
+                if event['seq'] > seq:
+                    apply_event(data, event)
+                    self._bump(event)
+                    seq = event['seq']
+        return data, seq
+
+    # --- Lifecycle ---
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name='store-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self.io_lock, registry.timer('store_flush_seconds'):
+            with self.lock:
+                lines, self.pending = self.pending, []
+            if not lines:
+                return 0
+            payload = ''.join(lines).encode('utf-8')
+            try:
+                with open(self.journal_path, 'ab') as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError:
+                with self.lock:
+                    self.pending[:0] = lines
+                registry.inc('store_flush_errors_total')
+                raise
+            registry.inc('store_written_bytes_total', len(payload), kind='journal')
+            if os.path.getsize(self.journal_path) > self.compact_bytes:
+                return len(payload) + self._compact()
+            return len(payload)
+
+    def compact(self):
+        with self.io_lock:
+            return self._compact()
+
+    def _compact(self):
+        # Записи з seq більшим за снапшот залишаються в pending і потраплять у новий журнал;
+        # якщо впадемо між записом снапшота і ротацією журналу, повтор відкине їх за seq.
+        # Згорнутий журнал не стирається, а переходить в архів data.journal.<seq снапшота> -
+        # історія змін лишається повною
+        with self.lock:
+            seq = self.seq
+            snapshot = dict(self.data, seq=seq, versions=dict(self._versions))
+            payload = json.dumps(snapshot, ensure_ascii=False, indent=2).encode('utf-8')
+        with registry.timer('store_compact_seconds'):
+            written = atomic_write(self.path, payload)
+            if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path):
+                archive, n = f'{self.journal_path}.{seq}', 0
+                while os.path.exists(archive):
+                    n += 1
+                    archive = f'{self.journal_path}.{seq}.{n}'
+                os.replace(self.journal_path, archive)
+        registry.inc('store_written_bytes_total', written, kind='snapshot')
+        return written
+
+    def _record(self, op, **event):
+        with self.lock:
+            self.seq += 1
+            event.update(op=op, seq=self.seq, ts=int(time.time()))
+            apply_event(self.data, event)
+            self._bump(event)
+            self.pending.append(json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def _bump(self, event):
+        for name in touched(event):
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def versions(self, *names):
+        return tuple(self._versions.get(name, 0) for name in names)
+
+    # --- Users ---
+    def users(self):
+        with self.lock:
+            return dict(self.data['users'])
+
+    def get_user(self, uid):
+        # Копія, як і в SqliteStore: apply_event змінює профіль на місці, і без неї
+        # update_user(expected=...) порівнював би з уже чужим записом
+        with self.lock:
+            return copy.deepcopy(self.data['users'].get(uid))
+
+    def update_user(self, uid, expected=None, **fields):
+        with self.lock:
+            check_expected(self.data['users'].get(uid) or {}, expected)
+            self._record('user_updated', uid=uid, fields=fields)
+
+    def register_user(self, uid, emoji, reminder_time):
+        self._record('user_registered', uid=uid, emoji=emoji, reminder_time=reminder_time)
+
+    def add_vacation(self, uid, vac):
+        self._record('vacation_added', uid=uid, **{'from': vac['from'], 'to': vac['to']})
+
+    def remove_user(self, uid):
+        with self.lock:
+            self._record('user_removed', uid=uid, **self._stale(uid=uid))
+
+    def import_rows(self, rows, defaults):
+        # Увесь імпорт - одна подія в журналі: або застосовано все, або нічого
+        rows = list(rows)
+        with self.lock:
+            users, batch, vacations, seen = self.data['users'], {}, [], set()
+            for uid, fields, vac in rows:
+                if fields:
+                    base = dict(defaults) if uid not in users and uid not in batch else {}
+                    batch.setdefault(uid, base).update(fields)
+                if vac:
+                    entry = (uid, vac['from'], vac['to'])
+                    if entry in seen or vac in users.get(uid, {}).get('vacation', []):
+                        continue  # повторний імпорт того самого файлу
+                    seen.add(entry)
+                    vacations.append(list(entry))
+            unknown = sorted({uid for uid, _, _ in vacations if uid not in users and uid not in batch})
+            if unknown:
+                raise ValueError(f'Vacations for unknown users: {", ".join(unknown[:10])}')
+            self._record('batch_imported', users=batch, vacations=vacations)
+        return len(batch), len(vacations)
+
+    # --- Schedules ---
+    def schedule(self, key):
+        return self.data.get(key, {})
+
+    def set_schedule(self, key, sched):
+        with self.lock:
+            self._record('schedule_generated', key=key, schedule=sched, **self._stale(lambda o: o['key'] == key))
+
+    def swap(self, key, fr, to_dt, uid, tgt):
+        with self.lock:
+            check_expected(self.data.get(key, {}), {fr: uid, to_dt: tgt})
+            self._record('duty_swapped', key=key, uid=uid, target=tgt, **{'from': fr, 'to': to_dt},
+                         **self._stale(lambda o: o['key'] == key and o['give'] in (fr, to_dt)))
+
+    def user_dates(self, key, uid):
+        return sorted(d for d, u in self.schedule(key).items() if u == uid)
+
+    def duty_uids(self, key):
+        return set(self.schedule(key).values())
+
+    def on_duty(self, key, iso):
+        return self.schedule(key).get(iso)
+
+    def duty_counts(self, key):
+        counts = {}
+        for uid in self.schedule(key).values():
+            counts[uid] = counts.get(uid, 0) + 1
+        return counts
+
+    def reassign(self, key, changes, old_uid):
+        # Передати окремі дні іншим людям; лише якщо вони досі за old_uid
+        with self.lock:
+            check_expected(self.data.get(key, {}), {iso: old_uid for iso in changes})
+            self._record('duties_reassigned', key=key, old_uid=old_uid, changes=changes,
+                         **self._stale(lambda o: o['key'] == key and o['give'] in changes))
+
+    def month_duties(self, month):
+        # (дата, uid) за місяць 'YYYY-MM' з обох розкладів; якщо дата є в обох, перемагає поточний
+        seen = set()
+        for key in ('schedule_current', 'schedule_next'):
+            for iso, uid in sorted(self.schedule(key).items()):
+                if iso.startswith(month) and iso not in seen:
+                    seen.add(iso)
+                    yield iso, uid
+
+    # --- Swap market ---
+    def _stale(self, match=None, uid=None):
+        # {'dropped': [oid]} для пропозицій, які подія робить недійсними, або {}
+        dropped = [oid for oid, o in self.data.get('offers', {}).items()
+                   if (match is not None and match(o)) or (uid is not None and o['uid'] == uid)]
+        return {'dropped': dropped} if dropped else {}
+
+    def offers(self):
+        with self.lock:
+            return dict(self.data.get('offers', {}))
+
+    def post_offer(self, uid, key, give, take):
+        with self.lock:
+            check_expected(self.data.get(key, {}), {give: uid})
+            oid = str(self.seq + 1)
+            self._record('offer_posted', oid=oid, offer={'uid': uid, 'key': key, 'give': give,
+                                                         'take': None if take is None else sorted(take), 'ts': time.time()})
+            return oid
+
+    def withdraw_offer(self, oid, uid):
+        with self.lock:
+            offer = self.data.get('offers', {}).get(oid)
+            if offer is None or offer['uid'] != uid:
+                return False
+            self._record('offer_withdrawn', oid=oid)
+            return True
+
+    def trade(self, moves, oids):
+        # moves: [(key, дата, хто віддає, хто бере)]; усі дати досі за тими, хто віддає,
+        # і всі пропозиції ще відкриті - інакше Conflict і нічого не змінено
+        with self.lock:
+            for key, iso, old_uid, _ in moves:
+                check_expected(self.data.get(key, {}), {iso: old_uid})
+            offers = self.data.get('offers', {})
+            if any(oid not in offers for oid in oids):
+                raise Conflict('offer')
+            moved = {(key, iso) for key, iso, _, _ in moves}
+            dropped = set(oids) | {oid for oid, o in offers.items() if (o['key'], o['give']) in moved}
+            self._record('trade_applied', moves=[list(move) for move in moves], dropped=sorted(dropped))
+
+    def expire_offers(self, today):
+        # Пропозиції на дати, що вже настали: обміняти їх не можна
+        with self.lock:
+            stale = self._stale(lambda o: o['give'] <= today)
+            if stale:
+                self._record('offer_expired', **stale)
+            return len(stale.get('dropped', ()))
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid TEXT PRIMARY KEY,
+    name TEXT,
+    emoji TEXT,
+    reminder_hour INTEGER,
+    reminder_minute INTEGER,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS vacations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL,
+    date_from TEXT NOT NULL,
+    date_to TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vacations_uid ON vacations(uid);
+CREATE TABLE IF NOT EXISTS duties (
+    schedule TEXT NOT NULL,
+    date TEXT NOT NULL,
+    month TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    PRIMARY KEY (schedule, date)
+);
+CREATE INDEX IF NOT EXISTS duties_user ON duties(schedule, uid, date);
+CREATE INDEX IF NOT EXISTS duties_user_month ON duties(uid, month);
+CREATE INDEX IF NOT EXISTS duties_month ON duties(month, date);
+CREATE TABLE IF NOT EXISTS offers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL,
+    key TEXT NOT NULL,
+    give TEXT NOT NULL,
+    take TEXT,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS offers_give ON offers(key, give);
+CREATE INDEX IF NOT EXISTS offers_uid ON offers(uid);
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+"""
+
+# SQLite-сховище: кожна зміна - окрема коротка транзакція, пошук чергувань іде по індексах
+class SqliteStore(Store):
+    def __init__(self, path):
+        self.path = path
+        self._db = LocalConnection(path, row_factory=sqlite3.Row)
+        self.conn.executescript(SCHEMA)
+
+    @property
+    def conn(self):
+        return self._db.get()
+
+    def close(self):
+        self._db.close()
+
+    @contextmanager
+    def _tx(self):
+        started = time.perf_counter()
+        try:
+            with transaction(self.conn) as conn:
+                yield conn
+        finally:
+            registry.observe('store_tx_seconds', time.perf_counter() - started)
+
+    def _log(self, conn, op, **event):
+        conn.execute('INSERT INTO journal (ts, op, payload) VALUES (?, ?, ?)',
+                     (int(time.time()), op, json.dumps(event, ensure_ascii=False, separators=(',', ':'))))
+
+    def _bump(self, conn, name):
+        conn.execute('INSERT INTO versions (name, version) VALUES (?, 1) '
+                     'ON CONFLICT(name) DO UPDATE SET version = version + 1', (name,))
+
+    def versions(self, *names):
+        found = {row['name']: row['version'] for row in self.conn.execute(
+            f"SELECT name, version FROM versions WHERE name IN ({','.join('?' * len(names))})", names)}
+        return tuple(found.get(name, 0) for name in names)
+
+    # --- Users ---
+    def _row_to_user(self, row, vacations):
+        user = json.loads(row['extra'])
+        if row['name'] is not None:
+            user['name'] = row['name']
+        if row['emoji'] is not None:
+            user['emoji'] = row['emoji']
+        if row['reminder_hour'] is not None:
+            user['reminder_time'] = {'hour': row['reminder_hour'], 'minute': row['reminder_minute']}
+        if vacations is not None:
+            user['vacation'] = vacations
+        return user
+
+    def users(self):
+        vacations = {}
+        for row in self.conn.execute('SELECT uid, date_from, date_to FROM vacations ORDER BY id'):
+            vacations.setdefault(row['uid'], []).append({'from': row['date_from'], 'to': row['date_to']})
+        return {row['uid']: self._row_to_user(row, vacations.get(row['uid'], []))
+                for row in self.conn.execute('SELECT * FROM users')}
+
+    def get_user(self, uid):
+        row = self.conn.execute('SELECT * FROM users WHERE uid = ?', (uid,)).fetchone()
+        if row is None:
+            return None
+        vacations = [{'from': r['date_from'], 'to': r['date_to']} for r in self.conn.execute(
+            'SELECT date_from, date_to FROM vacations WHERE uid = ? ORDER BY id', (uid,))]
+        return self._row_to_user(row, vacations)
+
+    def _write_user(self, conn, uid, fields):
+        row = conn.execute('SELECT extra FROM users WHERE uid = ?', (uid,)).fetchone()
+        extra = json.loads(row['extra']) if row else {}
+        if row is None:
+            conn.execute('INSERT INTO users (uid) VALUES (?)', (uid,))
+        self._bump(conn, 'users')
+        for field, value in fields.items():
+            if field == 'name':
+                conn.execute('UPDATE users SET name = ? WHERE uid = ?', (value, uid))
+            elif field == 'emoji':
+                conn.execute('UPDATE users SET emoji = ? WHERE uid = ?', (value, uid))
+            elif field == 'reminder_time':
+                conn.execute('UPDATE users SET reminder_hour = ?, reminder_minute = ? WHERE uid = ?',
+                             (value['hour'], value['minute'], uid))
+            elif field == 'vacation':
+                conn.execute('DELETE FROM vacations WHERE uid = ?', (uid,))
+                conn.executemany('INSERT INTO vacations (uid, date_from, date_to) VALUES (?, ?, ?)',
+                                 [(uid, v['from'], v['to']) for v in value])
+            else:
+                extra[field] = value
+        conn.execute('UPDATE users SET extra = ? WHERE uid = ?', (json.dumps(extra, ensure_ascii=False), uid))
+
+    def update_user(self, uid, expected=None, **fields):
+        with self._tx() as conn:
+            if expected:
+                check_expected(self.get_user(uid) or {}, expected)
+            self._write_user(conn, uid, fields)
+            self._log(conn, 'user_updated', uid=uid, fields=fields)
+
+    def register_user(self, uid, emoji, reminder_time):
+        with self._tx() as conn:
+            self._write_user(conn, uid, {'emoji': emoji, 'reminder_time': reminder_time})
+            self._log(conn, 'user_registered', uid=uid, emoji=emoji, reminder_time=reminder_time)
+
+    def add_vacation(self, uid, vac):
+        with self._tx() as conn:
+            if conn.execute('SELECT 1 FROM users WHERE uid = ?', (uid,)).fetchone() is None:
+                conn.execute('INSERT INTO users (uid) VALUES (?)', (uid,))
+            conn.execute('INSERT INTO vacations (uid, date_from, date_to) VALUES (?, ?, ?)',
+                         (uid, vac['from'], vac['to']))
+            self._log(conn, 'vacation_added', uid=uid, **{'from': vac['from'], 'to': vac['to']})
+
+    def remove_user(self, uid):
+        with self._tx() as conn:
+            conn.execute('DELETE FROM vacations WHERE uid = ?', (uid,))
+            conn.execute('DELETE FROM users WHERE uid = ?', (uid,))
+            self._drop_offers(conn, 'uid = ?', [(uid,)])
+            self._bump(conn, 'users')
+            self._log(conn, 'user_removed', uid=uid)
+
+    def import_rows(self, rows, defaults, chunk=1000):
+        # Одна транзакція на весь файл; рядки читаються й пишуться пачками, тож у пам'яті
+        # не більше chunk рядків незалежно від розміру імпорту
+        users, vacations = set(), 0
+        with self._tx() as conn:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= chunk:
+                    vacations += self._import_chunk(conn, batch, defaults, users)
+                    batch = []
+            vacations += self._import_chunk(conn, batch, defaults, users)
+            unknown = [row['uid'] for row in conn.execute(
+                'SELECT DISTINCT uid FROM vacations WHERE uid NOT IN (SELECT uid FROM users) LIMIT 10')]
+            if unknown:
+                raise ValueError(f'Vacations for unknown users: {", ".join(unknown)}')
+            self._bump(conn, 'users')
+            self._log(conn, 'batch_imported', users=len(users), vacations=vacations)
+        return len(users), vacations
+
+    def _import_chunk(self, conn, batch, defaults, users):
+        added = 0
+        for uid, fields, vac in batch:
+            if fields:
+                if uid not in users and conn.execute('SELECT 1 FROM users WHERE uid = ?', (uid,)).fetchone() is None:
+                    fields = dict(defaults, **fields)
+                self._write_user(conn, uid, fields)
+                users.add(uid)
+            if vac:
+                added += conn.execute(
+                    'INSERT INTO vacations (uid, date_from, date_to) SELECT ?, ?, ? WHERE NOT EXISTS '
+                    '(SELECT 1 FROM vacations WHERE uid = ? AND date_from = ? AND date_to = ?)',
+                    (uid, vac['from'], vac['to']) * 2).rowcount
+        return added
+
+    # --- Schedules ---
+    def schedule(self, key):
+        return {row['date']: row['uid'] for row in self.conn.execute(
+            'SELECT date, uid FROM duties WHERE schedule = ? ORDER BY date', (key,))}
+
+    def set_schedule(self, key, sched):
+        with self._tx() as conn:
+            conn.execute('DELETE FROM duties WHERE schedule = ?', (key,))
+            conn.executemany('INSERT INTO duties (schedule, date, month, uid) VALUES (?, ?, ?, ?)',
+                             [(key, iso, iso[:7], uid) for iso, uid in sched.items()])
+            self._drop_offers(conn, 'key = ?', [(key,)])
+            self._bump(conn, key)
+            self._log(conn, 'schedule_generated', key=key, days=len(sched))
+
+    def swap(self, key, fr, to_dt, uid, tgt):
+        with self._tx() as conn:
+            holders = {row['date']: row['uid'] for row in conn.execute(
+                'SELECT date, uid FROM duties WHERE schedule = ? AND date IN (?, ?)', (key, fr, to_dt))}
+            check_expected(holders, {fr: uid, to_dt: tgt})
+            conn.executemany('INSERT OR REPLACE INTO duties (schedule, date, month, uid) VALUES (?, ?, ?, ?)',
+                             [(key, fr, fr[:7], tgt), (key, to_dt, to_dt[:7], uid)])
+            self._drop_offers(conn, 'key = ? AND give = ?', [(key, fr), (key, to_dt)])
+            self._bump(conn, key)
+            self._log(conn, 'duty_swapped', key=key, uid=uid, target=tgt, **{'from': fr, 'to': to_dt})
+
+    def user_dates(self, key, uid):
+        return [row['date'] for row in self.conn.execute(
+            'SELECT date FROM duties WHERE uid = ? AND schedule = ? ORDER BY date', (uid, key))]
+
+    def duty_uids(self, key):
+        return {row['uid'] for row in self.conn.execute(
+            'SELECT DISTINCT uid FROM duties WHERE schedule = ?', (key,))}
+
+    def on_duty(self, key, iso):
+        row = self.conn.execute('SELECT uid FROM duties WHERE schedule = ? AND date = ?', (key, iso)).fetchone()
+        return row['uid'] if row else None
+
+    def duty_counts(self, key):
+        return {row['uid']: row['n'] for row in self.conn.execute(
+            'SELECT uid, COUNT(*) AS n FROM duties WHERE schedule = ? GROUP BY uid', (key,))}
+
+    def reassign(self, key, changes, old_uid):
+        with self._tx() as conn:
+            for iso, uid in changes.items():
+                updated = conn.execute('UPDATE duties SET uid = ? WHERE schedule = ? AND date = ? AND uid = ?',
+                                       (uid, key, iso, old_uid)).rowcount
+                if not updated:
+                    raise Conflict(iso)
+            self._drop_offers(conn, 'key = ? AND give = ?', [(key, iso) for iso in changes])
+            self._bump(conn, key)
+            self._log(conn, 'duties_reassigned', key=key, old_uid=old_uid, changes=changes)
+
+    def month_duties(self, month):
+        # Курсор по індексу duties_month: рядки читаються з бази по мірі споживання
+        last = None
+        for row in self.conn.execute('SELECT date, uid FROM duties WHERE month = ? ORDER BY date, schedule', (month,)):
+            if row['date'] != last:
+                last = row['date']
+                yield row['date'], row['uid']
+
+    # --- Swap market ---
+    def _drop_offers(self, conn, where, params):
+        dropped = sum(conn.execute(f'DELETE FROM offers WHERE {where}', p).rowcount for p in params)
+        if dropped:
+            self._bump(conn, 'offers')
+        return dropped
+
+    def offers(self):
+        return {str(row['id']): {'uid': row['uid'], 'key': row['key'], 'give': row['give'],
+                                 'take': None if row['take'] is None else json.loads(row['take']), 'ts': row['ts']}
+                for row in self.conn.execute('SELECT * FROM offers ORDER BY id')}
+
+    def post_offer(self, uid, key, give, take):
+        with self._tx() as conn:
+            if self.on_duty(key, give) != uid:
+                raise Conflict(give)
+            oid = conn.execute('INSERT INTO offers (uid, key, give, take, ts) VALUES (?, ?, ?, ?, ?)',
+                               (uid, key, give, None if take is None else json.dumps(sorted(take)),
+                                time.time())).lastrowid
+            self._bump(conn, 'offers')
+            self._log(conn, 'offer_posted', oid=oid, uid=uid, key=key, give=give)
+            return str(oid)
+
+    def withdraw_offer(self, oid, uid):
+        with self._tx() as conn:
+            if not self._drop_offers(conn, 'id = ? AND uid = ?', [(int(oid), uid)]):
+                return False
+            self._log(conn, 'offer_withdrawn', oid=oid)
+            return True
+
+    def trade(self, moves, oids):
+        with self._tx() as conn:
+            for key, iso, old_uid, new_uid in moves:
+                if not conn.execute('UPDATE duties SET uid = ? WHERE schedule = ? AND date = ? AND uid = ?',
+                                    (new_uid, key, iso, old_uid)).rowcount:
+                    raise Conflict(iso)
+            if self._drop_offers(conn, 'id = ?', [(int(oid),) for oid in oids]) != len(oids):
+                raise Conflict('offer')
+            self._drop_offers(conn, 'key = ? AND give = ?', [(key, iso) for key, iso, _, _ in moves])
+            for key in sorted({move[0] for move in moves}):
+                self._bump(conn, key)
+            self._log(conn, 'trade_applied', moves=[list(move) for move in moves], offers=list(oids))
+
+    def expire_offers(self, today):
+        with self._tx() as conn:
+            dropped = self._drop_offers(conn, 'give <= ?', [(today,)])
+            if dropped:
+                self._log(conn, 'offer_expired', before=today, offers=dropped)
+            return dropped
+
+
+# --- Migration ---
+def migrate_json_to_sqlite(json_path, db_path):
+    source = JsonStore(json_path)
+    data = source.data
+    target = SqliteStore(db_path)
+    with target._tx() as conn:
+        for uid, info in data.get('users', {}).items():
+            target._write_user(conn, uid, dict(info, vacation=info.get('vacation', [])))
+        for key in ('schedule_current', 'schedule_next'):
+            conn.execute('DELETE FROM duties WHERE schedule = ?', (key,))
+            conn.executemany('INSERT INTO duties (schedule, date, month, uid) VALUES (?, ?, ?, ?)',
+                             [(key, iso, iso[:7], uid) for iso, uid in data.get(key, {}).items()])
+        conn.executemany('INSERT INTO offers (uid, key, give, take, ts) VALUES (?, ?, ?, ?, ?)',
+                         [(o['uid'], o['key'], o['give'], None if o['take'] is None else json.dumps(o['take']), o['ts'])
+                          for o in data.get('offers', {}).values()])
+    return target
+
+
+def open_store(backend, json_path, db_path, journal_path=None, flush_interval=2.0, compact_bytes=1 << 20):
+    if backend == 'json':
+        return JsonStore(json_path, journal_path=journal_path, flush_interval=flush_interval,
+                         compact_bytes=compact_bytes)
+    if backend == 'sqlite':
+        if not os.path.exists(db_path) and os.path.exists(json_path):
+            return migrate_json_to_sqlite(json_path, db_path)
+        return SqliteStore(db_path)
+    raise ValueError(f'Unknown storage backend: {backend}')
+
+
+if __name__ == '__main__':
+    # python storage.py migrate data.json data.db
+    if len(sys.argv) != 4 or sys.argv[1] != 'migrate':
+        sys.exit('usage: python storage.py migrate <data.json> <data.db>')
+    migrate_json_to_sqlite(sys.argv[2], sys.argv[3]).close()
+    print(f'Migrated {sys.argv[2]} -> {sys.argv[3]}')
@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import fcntl
+import sqlite3
+import threading
+from storage import open_store, read_jsonl
+
+DEFAULT_TEAM = 'default'
+TEAM_ID = re.compile(r'-?\d+')
+
+
+# Кожна команда (груповий чат) - окремий шард зі своїм сховищем у власній теці:
+# запис однієї команди ніколи не читає й не переписує дані інших.
+# Команда 'default' живе у старих файлах (data.json/data.db), тож однокомандні
+# інсталяції працюють як раніше. Шарди відкриваються лише при першому зверненні
+class TeamStores:
+    def __init__(self, backend, root, default_paths, **options):
+        self.backend = backend
+        self.root = root
+        self.default_paths = default_paths  # (json_path, db_path, journal_path)
+        self.options = options
+        self.stores = {}
+        self.lock = threading.Lock()
+
+    def paths(self, team):
+        if team == DEFAULT_TEAM:
+            return self.default_paths
+        if not TEAM_ID.fullmatch(team):
+            raise ValueError(f'Bad team id: {team!r}')
+        folder = os.path.join(self.root, team)
+        return (os.path.join(folder, 'data.json'), os.path.join(folder, 'data.db'),
+                os.path.join(folder, 'data.journal'))
+
+    def file(self, team, name):
+        # Допоміжний файл поруч із даними команди (напр. збережений індекс нагадувань)
+        return os.path.join(os.path.dirname(self.paths(team)[0]), name)
+
+    def probe(self, team):
+        # Відбиток даних шарду без його відкриття: таблиця версій SQLite або розміри й час зміни
+        # файлів JSON-сховища. Той самий відбиток - дані не змінювались; None - не визначити
+        json_path, db_path, journal_path = self.paths(team)
+        if self.backend == 'sqlite':
+            if not os.path.exists(db_path):
+                return None
+            store = self.stores.get(team)
+            conn = store.conn if store is not None else sqlite3.connect(db_path, timeout=30)
+            try:
+                return [list(row) for row in conn.execute('SELECT name, version FROM versions ORDER BY name')]
+            except sqlite3.OperationalError:
+                return None  # таблиць ще немає
+            finally:
+                if store is None:
+                    conn.close()
+        stamp = []
+        for path in (json_path, journal_path):
+            try:
+                st = os.stat(path)
+            except OSError:
+                stamp.append(None)
+            else:
+                stamp.append([st.st_size, st.st_mtime_ns])
+        return stamp
+
+    def get(self, team):
+        store = self.stores.get(team)
+        if store is not None:
+            return store
+        with self.lock:
+            store = self.stores.get(team)
+            if store is None:
+                json_path, db_path, journal_path = self.paths(team)
+                os.makedirs(os.path.dirname(json_path) or '.', exist_ok=True)
+                store = open_store(self.backend, json_path, db_path, journal_path=journal_path, **self.options)
+                store.start()
+                self.stores[team] = store
+            return store
+
+    def known(self):
+        # Команди, що мають шард на диску, плюс 'default'
+        teams = [DEFAULT_TEAM]
+        if os.path.isdir(self.root):
+            teams += sorted(name for name in os.listdir(self.root)
+                            if TEAM_ID.fullmatch(name) and os.path.isdir(os.path.join(self.root, name)))
+        return teams
+
+    def close(self):
+        with self.lock:
+            stores, self.stores = list(self.stores.values()), {}
+        for store in stores:
+            store.close()
+
+
+# Хто в якій команді: uid -> team. Приєднання рідкісні, тож кожне - один рядок
+# у кінці members.jsonl; останній запис перемагає. Файл дочитується перед кожним
+# пошуком, якщо виріс: у кластері /join у групі й особисті повідомлення того самого
+# користувача обробляють різні воркери
+class TeamDirectory:
+    def __init__(self, path):
+        self.path = path
+        self.members = {}
+        self.offset = 0  # скільки байтів файлу вже прочитано
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            # Як журнал сховища: обірваний хвіст обрізати, щоб наступний /join не злився з ним.
+            # Під flock - інші воркери саме зараз не дописують
+            with open(path, 'rb') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                for entry in read_jsonl(path):
+                    self.members[entry['uid']] = entry['team']
+                self.offset = os.fstat(f.fileno()).st_size
+
+    def refresh(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size == self.offset:
+            return
+        with self.lock:
+            if size < self.offset:  # файл замінили - прочитати заново
+                self.members, self.offset = {}, 0
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                chunk = f.read()
+            end = chunk.rfind(b'\n') + 1  # недописаний іншим процесом рядок - наступного разу
+            for line in chunk[:end].splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # обірваний запис після аварійної зупинки
+                self.members[entry['uid']] = entry['team']
+            self.offset += end
+
+    def team_of(self, uid):
+        self.refresh()
+        return self.members.get(str(uid), DEFAULT_TEAM)
+
+    def join(self, uid, team):
+        self.join_many([uid], team)
+
+    def join_many(self, uids, team):
+        # Масовий імпорт: усі нові записи одним дописом і одним fsync
+        self.refresh()
+        uids = [str(uid) for uid in uids if self.members.get(str(uid)) != team]
+        if not uids:
+            return
+        payload = ''.join(json.dumps({'uid': uid, 'team': team}) + '\n' for uid in uids)
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            for uid in uids:
+                self.members[uid] = team
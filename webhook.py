@@ -0,0 +1,34 @@
+import logging
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+
+# Приймач вебхуків на asyncio/aiohttp: Telegram сам надсилає оновлення, без long-poll.
+# Цикл подій лише розбирає оновлення; хендлери, як і в режимі polling, ідуть у пул
+# HANDLER_THREADS: вони можуть чекати на блокування SQLite, fsync чи завантаження файлу
+def make_app(bot, path, secret=None):
+    from aiohttp import web
+
+    async def receive(request):
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=403)
+        try:
+            update = types.Update.de_json(await request.text())
+            bot.process_new_updates([update])
+        except Exception:
+            # 200 все одно: інакше Telegram надсилатиме те саме оновлення знову й знову
+            logger.exception('Failed to process webhook update')
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    return app
+
+
+def run_webhook(bot, host, port, path, url=None, secret=None):
+    from aiohttp import web
+
+    if url:
+        bot.set_webhook(url=url.rstrip('/') + path, secret_token=secret)
+    web.run_app(make_app(bot, path, secret), host=host, port=port, print=None)